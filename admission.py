@@ -0,0 +1,110 @@
+# admission.py
+#
+# التحكم في القبول (admission control) لمسارات التحليل الثقيلة:
+# عدد محدود من الطلبات ينفذ بنفس الوقت، والباقي ينتظر لمدة قصيرة فقط،
+# وبعدها نرد بـ 503 + Retry-After بدل ما تتكدس الطلبات للأبد.
+# باقي المسارات (auth, history, plans...) ما تمر من هنا أبدًا.
+# الـ slot ينحجز بعد ما يوصل الـ body كامل (dependency وليس middleware).
+
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from fastapi import Request, status
+from fastapi.responses import JSONResponse
+
+from analysis_pool import ANALYSIS_POOL_SIZE, ANALYSIS_RETRY_AFTER
+
+
+# أقصى عدد طلبات تحليل تنفذ بنفس الوقت (0 = ضعف حجم الـ pool)
+ANALYSIS_MAX_INFLIGHT = int(os.getenv("ANALYSIS_MAX_INFLIGHT", "0")) or ANALYSIS_POOL_SIZE * 2
+# أقصى مدة ينتظرها الطلب قبل ما نرفضه (ميلي ثانية)
+ANALYSIS_MAX_WAIT_MS = float(os.getenv("ANALYSIS_MAX_WAIT_MS", "2000"))
+
+class AdmissionRejected(Exception):
+    pass
+
+
+class AdmissionLimiter:
+    def __init__(self, name: str, max_inflight: int, max_wait_seconds: float) -> None:
+        self.name = name
+        self.max_inflight = max_inflight
+        self.max_wait_seconds = max_wait_seconds
+        self._semaphore = asyncio.Semaphore(max_inflight)
+        self.inflight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.waited = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        start = time.perf_counter()
+        if self._semaphore.locked():
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), self.max_wait_seconds)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                raise AdmissionRejected()
+            finally:
+                self.waiting -= 1
+
+            waited = time.perf_counter() - start
+            self.waited += 1
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+        else:
+            await self._semaphore.acquire()
+
+        self.admitted += 1
+        self.inflight += 1
+        try:
+            yield
+        finally:
+            self.inflight -= 1
+            self._semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            "lane": self.name,
+            "max_inflight": self.max_inflight,
+            "max_wait_ms": self.max_wait_seconds * 1000,
+            "inflight": self.inflight,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "waited": self.waited,
+            "wait_ms_total": round(self.wait_seconds_total * 1000, 3),
+            "wait_ms_max": round(self.wait_seconds_max * 1000, 3),
+        }
+
+
+analysis_limiter = AdmissionLimiter(
+    "analysis",
+    ANALYSIS_MAX_INFLIGHT,
+    ANALYSIS_MAX_WAIT_MS / 1000,
+)
+
+
+async def analysis_admission() -> AsyncIterator[None]:
+    """Dependency for the analysis routes: holds an ``analysis_limiter`` slot.
+
+    FastAPI reads the multipart body before it resolves dependencies, so the
+    slot covers ingest and the CPU work, not the upload itself; a slow mobile
+    upload doesn't keep a slot busy while the server sits idle.
+    """
+    async with analysis_limiter.slot():
+        yield
+
+
+async def admission_rejected_handler(request: Request, exc: AdmissionRejected) -> JSONResponse:
+    return JSONResponse(
+        {"success": False, "message": "Server is busy, please try again shortly."},
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        headers={"Retry-After": str(ANALYSIS_RETRY_AFTER)},
+    )
@@ -0,0 +1,232 @@
+# analysis.py
+#
+# منطق تحليل الصور "الصافي" (بدون FastAPI أو قاعدة بيانات).
+# هذه الدوال تعمل داخل الـ worker pool (انظر analysis_pool.py)، لذلك يجب أن تبقى
+# دوال على مستوى الموديول وتستقبل/ترجع قيمًا بسيطة قابلة للـ pickle.
+
+import io
+import time
+from typing import BinaryIO, Dict, Tuple, Union
+
+from PIL import Image
+
+from image_features import food_color_features, image_array, upper_half_luminance
+
+
+# الصورة إما bytes (process pool) أو ملف الرفع نفسه (thread pool، بدون نسخ)
+ImageSource = Union[bytes, BinaryIO]
+
+
+# ------------- Image Helper --------------
+
+# كل التحليل يشتغل على صورة مصغّرة بهذا الحجم
+ANALYSIS_IMAGE_SIZE = (256, 256)
+
+# قيمة EXIF Orientation -> التحويل اللازم (نفس جدول ImageOps.exif_transpose)
+_EXIF_ORIENTATION_TAG = 0x0112
+_EXIF_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+
+def _decode(source: ImageSource) -> Tuple[Image.Image, int]:
+    """Decode an upload in RGB, as close to ANALYSIS_IMAGE_SIZE as the format allows.
+
+    Returns the image and its EXIF orientation (applied later by _reduce).
+    """
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    img = Image.open(source)
+
+    # Image.open يقرأ الهيدر فقط؛ نقرأ الـ orientation قبل فك الترميز
+    orientation = img.getexif().get(_EXIF_ORIENTATION_TAG, 1)
+
+    # JPEG: libjpeg يقدر يفك الصورة مباشرة بمقياس 1/2 أو 1/4 أو 1/8 (DCT scaling)
+    # بحيث تبقى أكبر من أو تساوي الحجم المطلوب. PNG/WebP يتجاهلون draft
+    # ويتصغرون عن طريق thumbnail (اللي يستخدم reduce() للتصغير الكبير).
+    if img.format == "JPEG":
+        img.draft("RGB", ANALYSIS_IMAGE_SIZE)
+
+    return img.convert("RGB"), orientation
+
+
+def _reduce(img: Image.Image, orientation: int) -> Image.Image:
+    img.thumbnail(ANALYSIS_IMAGE_SIZE)
+
+    # تدوير الصورة الصغيرة أرخص بكثير من تدوير الأصلية
+    method = _EXIF_TRANSPOSE.get(orientation)
+    if method is not None:
+        img = img.transpose(method)
+    return img
+
+
+def _open_image(source: ImageSource) -> Image.Image:
+    return _reduce(*_decode(source))
+
+
+# ------------- Body Analysis --------------
+
+def body_features(img: Image.Image) -> Tuple[float, float]:
+    """Returns (average upper-half luminance, rounded aspect ratio) for one photo."""
+    w, h = img.size
+    aspect_ratio = round(h / w, 3) if w > 0 else 1.0
+
+    avg_lum = upper_half_luminance(image_array(img))
+
+    return avg_lum, aspect_ratio
+
+
+def score_body(avg_lum: float, aspect_ratio: float) -> Dict:
+    relative_lum = max(0.0, min(1.0, (avg_lum - 80) / (210 - 80)))
+
+    fat_percent = 12 + relative_lum * 16
+    muscle_percent = 30 + (1 - relative_lum) * 20
+    bmi = 20 + (fat_percent - 12) * (10 / 16)
+
+    if fat_percent <= 13.5:
+        shape_key = "very_athletic"
+        advice_key = "athletic"
+    elif fat_percent <= 17:
+        shape_key = "athletic"
+        advice_key = "athletic"
+    elif fat_percent <= 22:
+        shape_key = "balanced"
+        advice_key = "balanced"
+    elif fat_percent <= 26:
+        shape_key = "full"
+        advice_key = "full"
+    else:
+        shape_key = "high_fat"
+        advice_key = "high_fat"
+
+    return {
+        "shape_key": shape_key,
+        "advice_key": advice_key,
+        "body_fat": fat_percent,
+        "muscle_mass": muscle_percent,
+        "bmi": bmi,
+        "aspect_ratio": aspect_ratio,
+    }
+
+
+def combine_body_two(
+    front_features: Tuple[float, float],
+    side_features: Tuple[float, float],
+) -> Dict:
+    """Combine the per-photo features of the front and side images.
+
+    Cheap enough to run on the event loop once both decodes have finished.
+    """
+    avg_lum_f, aspect_front = front_features
+    avg_lum_s, aspect_side = side_features
+
+    # Combined analysis (average of both images)
+    avg_lum = (avg_lum_f + avg_lum_s) / 2
+    relative_lum = max(0.0, min(1.0, (avg_lum - 80) / (210 - 80)))
+
+    # More accurate with 2 photos - slightly adjusted ranges
+    fat_percent = 10 + relative_lum * 18
+    muscle_percent = 32 + (1 - relative_lum) * 22
+    bmi = 19 + (fat_percent - 10) * (12 / 18)
+    aspect_ratio = (aspect_front + aspect_side) / 2
+
+    if fat_percent <= 12.5:
+        shape_key = "very_athletic"
+        advice_key = "athletic"
+    elif fat_percent <= 16:
+        shape_key = "athletic"
+        advice_key = "athletic"
+    elif fat_percent <= 21:
+        shape_key = "balanced"
+        advice_key = "balanced"
+    elif fat_percent <= 25:
+        shape_key = "full"
+        advice_key = "full"
+    else:
+        shape_key = "high_fat"
+        advice_key = "high_fat"
+
+    return {
+        "shape_key": shape_key,
+        "advice_key": advice_key,
+        "body_fat": fat_percent,
+        "muscle_mass": muscle_percent,
+        "bmi": bmi,
+        "aspect_ratio": aspect_ratio,
+    }
+
+
+# ------------- Food Analysis --------------
+
+def food_features(img: Image.Image) -> Dict[str, float]:
+    return food_color_features(image_array(img))
+
+
+def classify_food(features: Dict[str, float]) -> Dict:
+    avg_brightness = features["brightness"]
+    yellow_level = features["yellow_level"]
+    green_level = features["green_level"]
+
+    yellow_score = max(0.0, min(1.0, (yellow_level - 0) / 90))
+    green_score = max(0.0, min(1.0, (green_level + 20) / 140))
+    brightness_norm = max(0.0, min(1.0, (avg_brightness - 60) / 210))
+
+    is_high_cal = yellow_score >= 0.3 and brightness_norm > 0.25
+    is_light = green_score >= 0.55 and yellow_score < 0.2
+
+    if is_high_cal and not is_light:
+        meal_key = "high_cal"
+        calories = 800
+        protein = 30
+        carbs = 95
+        fats = 40
+    elif is_light and not is_high_cal:
+        meal_key = "light"
+        calories = 280
+        protein = 10
+        carbs = 30
+        fats = 8
+    else:
+        meal_key = "moderate"
+        calories = 550
+        protein = 25
+        carbs = 60
+        fats = 18
+
+    return {
+        "meal_key": meal_key,
+        "calories": calories,
+        "protein": protein,
+        "carbs": carbs,
+        "fats": fats,
+    }
+
+
+# ------------- Pool Entry Point --------------
+
+FEATURE_EXTRACTORS = {
+    "body": body_features,
+    "food": food_features,
+}
+
+
+def extract_features(kind: str, source: ImageSource) -> Tuple[object, Dict[str, float]]:
+    """Decode one upload and extract its features, timing both stages.
+
+    The timings are measured inside the worker so they exclude time spent
+    waiting for a free worker.
+    """
+    start = time.perf_counter()
+    img = _open_image(source)
+    decoded = time.perf_counter()
+    features = FEATURE_EXTRACTORS[kind](img)
+    return features, {
+        "decode": decoded - start,
+        "features": time.perf_counter() - decoded,
+    }
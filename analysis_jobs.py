@@ -0,0 +1,147 @@
+# analysis_jobs.py
+#
+# وضع "job" للتحليل: الطلب يرجع job_id فورًا، والتحليل يتنفذ في الخلفية من طابور
+# محدود الحجم، والعميل يسأل عن النتيجة عبر GET /analysis/jobs/{id}.
+# الطابور موجود داخل العملية (in-process)، فكل worker في uvicorn عنده طابوره الخاص.
+
+import asyncio
+import logging
+import os
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from analysis_pool import ANALYSIS_POOL_SIZE, ANALYSIS_RETRY_AFTER, AnalysisPoolBusy
+
+logger = logging.getLogger("bodytalk.jobs")
+
+# أقصى عدد jobs تنتظر في الطابور قبل ما نرفض بـ 503
+ANALYSIS_JOB_QUEUE_SIZE = int(os.getenv("ANALYSIS_JOB_QUEUE_SIZE", "64"))
+# عدد المهام اللي تسحب من الطابور بالتوازي
+ANALYSIS_JOB_WORKERS = int(os.getenv("ANALYSIS_JOB_WORKERS", "0")) or ANALYSIS_POOL_SIZE
+# مدة الاحتفاظ بنتيجة الـ job بعد انتهائه (ثواني)
+ANALYSIS_JOB_TTL = float(os.getenv("ANALYSIS_JOB_TTL", "600"))
+# كم مرة نعيد المحاولة لو الـ pool ممتلئ قبل ما نعتبر الـ job فاشل
+_BUSY_RETRIES = 10
+
+
+class JobQueueFull(Exception):
+    """Raised when the job queue already holds ANALYSIS_JOB_QUEUE_SIZE jobs."""
+
+
+@dataclass
+class AnalysisJob:
+    id: str
+    kind: str
+    user_id: Optional[int]
+    run: Optional[Callable[[], Awaitable[dict]]]
+    status: str = "queued"  # queued / running / done / failed
+    created_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    result: Optional[dict] = None
+    error: Optional[str] = None
+
+    def to_dict(self) -> dict:
+        data = {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+        }
+        if self.status == "done":
+            data["result"] = self.result
+        elif self.status == "failed":
+            data["error"] = self.error
+        return data
+
+
+class AnalysisJobQueue:
+    def __init__(self, maxsize: int, workers: int, ttl_seconds: float) -> None:
+        self.maxsize = maxsize
+        self.workers = workers
+        self.ttl_seconds = ttl_seconds
+        self._jobs: Dict[str, AnalysisJob] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self.rejected = 0
+
+    async def start(self) -> None:
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(
+        self,
+        kind: str,
+        user_id: Optional[int],
+        run: Callable[[], Awaitable[dict]],
+    ) -> AnalysisJob:
+        self._purge_expired()
+        job = AnalysisJob(id=uuid.uuid4().hex, kind=kind, user_id=user_id, run=run)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise JobQueueFull()
+        self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id: str) -> Optional[AnalysisJob]:
+        self._purge_expired()
+        return self._jobs.get(job_id)
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "max_queued": self.maxsize,
+            "workers": self.workers,
+            "stored": len(self._jobs),
+            "rejected": self.rejected,
+        }
+
+    def _purge_expired(self) -> None:
+        cutoff = time.time() - self.ttl_seconds
+        expired = [
+            job_id
+            for job_id, job in self._jobs.items()
+            if job.finished_at is not None and job.finished_at < cutoff
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._queue.get()
+            job.status = "running"
+            try:
+                job.result = await self._run_with_retry(job)
+                job.status = "done"
+            except Exception as e:
+                logger.exception("analysis job %s failed", job.id)
+                job.error = str(e)
+                job.status = "failed"
+            finally:
+                job.finished_at = time.time()
+                # نحرر الصور المرفوعة اللي كانت محجوزة في الـ closure
+                job.run = None
+                self._queue.task_done()
+
+    async def _run_with_retry(self, job: AnalysisJob) -> dict:
+        for _ in range(_BUSY_RETRIES):
+            try:
+                return await job.run()
+            except AnalysisPoolBusy:
+                await asyncio.sleep(ANALYSIS_RETRY_AFTER)
+        raise RuntimeError("Server is busy, please try again shortly.")
+
+
+job_queue = AnalysisJobQueue(
+    ANALYSIS_JOB_QUEUE_SIZE,
+    ANALYSIS_JOB_WORKERS,
+    ANALYSIS_JOB_TTL,
+)
@@ -0,0 +1,72 @@
+# analysis_pool.py
+#
+# طبقة تنفيذ التحليل: كل شغل الصور (فك الترميز + حساب الخصائص) يتنفذ هنا
+# في pool منفصل بدل ما يوقف الـ event loop الخاص بـ uvicorn.
+
+import asyncio
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Optional
+
+
+# "thread" = فك ترميز PIL وحسابات NumPy يحررون الـ GIL، والملف المرفوع يتسلم بدون نسخ
+# "process" = عزل كامل، لكن الصورة تنتقل كـ bytes لكل worker
+ANALYSIS_POOL_KIND = os.getenv("ANALYSIS_POOL_KIND", "thread").lower()
+# 0 = عدد الأنوية المتاحة
+ANALYSIS_POOL_SIZE = int(os.getenv("ANALYSIS_POOL_SIZE", "0")) or (os.cpu_count() or 1)
+# عدد المهام المسموح لها تنتظر فوق عدد الـ workers قبل ما نرفض الطلب
+ANALYSIS_QUEUE_DEPTH = int(os.getenv("ANALYSIS_QUEUE_DEPTH", "32"))
+# القيمة اللي نرجعها في Retry-After لما يكون الـ pool ممتلئ (بالثواني)
+ANALYSIS_RETRY_AFTER = int(os.getenv("ANALYSIS_RETRY_AFTER", "2"))
+
+
+class AnalysisPoolBusy(Exception):
+    """Raised when the pool already has size + queue depth tasks pending."""
+
+
+_executor: Optional[Executor] = None
+_pending = 0
+
+
+def get_executor() -> Executor:
+    global _executor
+    if _executor is None:
+        if ANALYSIS_POOL_KIND == "thread":
+            _executor = ThreadPoolExecutor(
+                max_workers=ANALYSIS_POOL_SIZE,
+                thread_name_prefix="analysis",
+            )
+        else:
+            _executor = ProcessPoolExecutor(max_workers=ANALYSIS_POOL_SIZE)
+    return _executor
+
+
+async def run_analysis(fn: Callable[..., Any], *args: Any) -> Any:
+    """Run a CPU-bound analysis function on the pool without blocking the loop."""
+    global _pending
+    if _pending >= ANALYSIS_POOL_SIZE + ANALYSIS_QUEUE_DEPTH:
+        raise AnalysisPoolBusy()
+
+    _pending += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_executor(), partial(fn, *args))
+    finally:
+        _pending -= 1
+
+
+def pool_stats() -> dict:
+    return {
+        "kind": ANALYSIS_POOL_KIND,
+        "size": ANALYSIS_POOL_SIZE,
+        "queue_depth": ANALYSIS_QUEUE_DEPTH,
+        "pending": _pending,
+    }
+
+
+def shutdown_pool() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
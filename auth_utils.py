@@ -1,8 +1,14 @@
 # auth_utils.py
 
+import asyncio
+import calendar
+import logging
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import AsyncGenerator, Dict, Optional, Tuple
 
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
@@ -10,9 +16,15 @@ from jose import JWTError, jwt
 from passlib.context import CryptContext
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import make_transient_to_detached
 
-from db import get_session
-from models import User
+from cache import LRUCache
+from db import AsyncSessionLocal, get_session, read_session
+from metrics import password_hash_seconds
+from models import TokenRevocation, User
+
+logger = logging.getLogger("bodytalk.auth")
 
 
 # مفتاح التشفير للـ JWT (غيره في الإنتاج)
@@ -20,7 +32,22 @@ SECRET_KEY = os.getenv("JWT_SECRET", "CHANGE_ME_DEV_SECRET")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # أسبوع
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# تكلفة bcrypt (log2 عدد الجولات). تغييرها يعيد تشفير كلمات المرور تلقائيًا عند الدخول
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# عدد threads المخصصة لـ bcrypt (0 = عدد الأنوية). bcrypt يحرر الـ GIL
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "0")) or (os.cpu_count() or 1)
+
+# min = max = default: أي hash بتكلفة مختلفة (أقل أو أكثر) يعتبره needs_update قديم
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
+
+# قيمة hashed_password لحسابات Google/Apple: مو hash صالح، فما تطابق أي كلمة مرور
+UNUSABLE_PASSWORD = "!"
 
 # يستقبل التوكن من الهيدر "Authorization: Bearer <token>"
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
@@ -28,18 +55,83 @@ oauth2_scheme_optional = OAuth2PasswordBearer(tokenUrl="/auth/login", auto_error
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    start = time.perf_counter()
+    try:
+        return pwd_context.verify(plain_password, hashed_password)
+    finally:
+        password_hash_seconds.observe(time.perf_counter() - start, operation="verify")
 
 
 def get_password_hash(password: str) -> str:
-    # قطع كلمة المرور إلى 72 حرفًا لتجنب خطأ bcrypt
-    return pwd_context.hash(password[:72])
+    start = time.perf_counter()
+    try:
+        # قطع كلمة المرور إلى 72 حرفًا لتجنب خطأ bcrypt
+        return pwd_context.hash(password[:72])
+    finally:
+        password_hash_seconds.observe(time.perf_counter() - start, operation="hash")
+
+
+def _verify_and_rehash(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    if hashed_password == UNUSABLE_PASSWORD:
+        return False, None
+    if not verify_password(plain_password, hashed_password):
+        return False, None
+    if pwd_context.needs_update(hashed_password):
+        return True, get_password_hash(plain_password)
+    return True, None
+
+
+# ------------- Hashing Pool --------------
+# bcrypt ياخذ مئات الميلي ثواني؛ تشغيله داخل الـ handler يوقف الـ event loop كامل.
+# pool منفصل عن pool التحليل حتى تسجيل الدخول ما ينتظر خلف الصور والعكس.
+
+_hash_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _get_hash_executor() -> ThreadPoolExecutor:
+    global _hash_executor
+    if _hash_executor is None:
+        _hash_executor = ThreadPoolExecutor(
+            max_workers=PASSWORD_HASH_WORKERS,
+            thread_name_prefix="bcrypt",
+        )
+    return _hash_executor
+
+
+async def _run_hash(fn, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_hash_executor(), fn, *args)
+
+
+async def get_password_hash_async(password: str) -> str:
+    return await _run_hash(get_password_hash, password)
+
+
+async def verify_and_update_password(
+    plain_password: str,
+    hashed_password: str,
+) -> Tuple[bool, Optional[str]]:
+    """Verify off the event loop.
+
+    Returns ``(ok, new_hash)``; ``new_hash`` is set when the password is
+    correct but the stored hash uses a different cost than BCRYPT_ROUNDS.
+    """
+    return await _run_hash(_verify_and_rehash, plain_password, hashed_password)
+
+
+def shutdown_hash_pool() -> None:
+    global _hash_executor
+    if _hash_executor is not None:
+        _hash_executor.shutdown(wait=True)
+        _hash_executor = None
 
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     to_encode = data.copy()
-    expire = datetime.utcnow() + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
-    to_encode.update({"exp": expire})
+    now = datetime.utcnow()
+    expire = now + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
+    # iat بأجزاء الثانية (jose يقرب الـ datetime لثواني كاملة) حتى يتقارن مع revoked_before
+    to_encode.update({"exp": expire, "iat": _timestamp(now)})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
@@ -54,42 +146,282 @@ async def get_user_by_email(email: str, session: AsyncSession) -> Optional[User]
     return result.scalar_one_or_none()
 
 
-async def _get_user_from_token(token: str, session: AsyncSession) -> Optional[User]:
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        sub = payload.get("sub")
-        if sub is None:
+# ------------- User Creation --------------
+# INSERT ... ON CONFLICT (email) ... RETURNING: إنشاء المستخدم أو جلبه بجملة وحدة
+# بدل SELECT ثم INSERT ثم refresh، وبدون IntegrityError لما يسجل نفس الإيميل مرتين بنفس اللحظة.
+
+def _insert_users(session: AsyncSession):
+    dialect = postgresql if session.get_bind().dialect.name == "postgresql" else sqlite
+    return dialect.insert(User)
+
+
+async def create_user_if_absent(values: dict, session: AsyncSession) -> Optional[User]:
+    """Insert a user; returns None (and inserts nothing) if the email is taken."""
+    stmt = (
+        _insert_users(session)
+        .values(**values)
+        .on_conflict_do_nothing(index_elements=[User.email])
+        .returning(User)
+    )
+    user = (await session.scalars(stmt)).one_or_none()
+    await session.commit()
+    return user
+
+
+async def get_or_create_user_id(values: dict, session: AsyncSession) -> int:
+    """Insert a user unless the email exists; returns the user's id either way.
+
+    ``DO NOTHING`` returns no row on conflict, so the existing id is read
+    with a plain SELECT; the existing row is never written to.
+    """
+    stmt = (
+        _insert_users(session)
+        .values(**values)
+        .on_conflict_do_nothing(index_elements=[User.email])
+        .returning(User.id)
+    )
+    user_id = (await session.execute(stmt)).scalar_one_or_none()
+    if user_id is None:
+        user_id = (
+            await session.execute(select(User.id).where(User.email == values["email"]))
+        ).scalar_one()
+    await session.commit()
+    return user_id
+
+
+# ------------- Auth Cache --------------
+# كل طلب مسجل كان يفك الـ JWT ويعمل SELECT على users. هنا نحفظ:
+#   token -> user_id (لين ما ينتهي التوكن أو AUTH_CACHE_TTL، أيهما أقرب)
+#   user_id -> نسخة من أعمدة المستخدم (تنحذف عند تعديل الملف الشخصي)
+# الكاش لكل process؛ مع عدة workers الـ TTL هو أقصى مدة لبيانات قديمة.
+
+# عدد العناصر في كل كاش (0 = تعطيل)
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "4096"))
+# أقصى عمر للعنصر بالثواني
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "300"))
+
+token_cache = LRUCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+user_cache = LRUCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+
+
+def _user_snapshot(user: User) -> dict:
+    return {column.key: getattr(user, column.key) for column in User.__table__.columns}
+
+
+def invalidate_cached_user(user_id: int) -> None:
+    user_cache.invalidate(user_id)
+
+
+def auth_cache_stats() -> dict:
+    return {
+        "tokens": token_cache.stats(),
+        "users": user_cache.stats(),
+        # كل hit في كاش المستخدمين = SELECT ما انعمل
+        "user_queries_saved": user_cache.hits,
+    }
+
+
+def _decode_token(token: str) -> Optional[Tuple[int, dict]]:
+    """Returns (user_id, claims) for a valid, non-revoked token."""
+    decoded = token_cache.get(token)
+    if decoded is None:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            sub = payload.get("sub")
+            if sub is None:
+                return None
+            decoded = (int(sub), payload)
+        except (JWTError, ValueError):
             return None
-        user_id = int(sub)
-    except (JWTError, ValueError):
+
+        ttl = AUTH_CACHE_TTL
+        exp = payload.get("exp")
+        if exp is not None:
+            ttl = min(ttl, exp - time.time())
+        if ttl > 0:
+            token_cache.set(token, decoded, ttl)
+
+    if _is_revoked(*decoded):
         return None
+    return decoded
+
+
+async def _get_user_from_token(token: str, session: AsyncSession) -> Optional[User]:
+    decoded = _decode_token(token)
+    if decoded is None:
+        return None
+    user_id = decoded[0]
+
+    snapshot = user_cache.get(user_id)
+    if snapshot is not None:
+        # نرجع كائن مربوط بالجلسة بدون استعلام، فالتعديل عليه (update_me) يشتغل عادي
+        user = User(**snapshot)
+        make_transient_to_detached(user)
+        return await session.merge(user, load=False)
 
     user = await get_user_by_id(user_id, session)
+    if user is not None:
+        user_cache.set(user_id, _user_snapshot(user))
     return user
 
 
-async def get_current_user(
-    token: str = Depends(oauth2_scheme),
-    session: AsyncSession = Depends(get_session),
-) -> User:
-    credentials_exception = HTTPException(
+# ------------- Token Revocation --------------
+# التوكنات stateless، فإلغاؤها (حذف المستخدم، تسجيل الخروج من كل الأجهزة) يكون
+# بتاريخ: أي توكن للمستخدم صادر قبل revoked_before مرفوض. الجدول صغير، فكل
+# process يحمله كامل في الذاكرة ويحدثه كل REVOCATION_REFRESH_SECONDS، وبكذا
+# التحقق ما يحتاج استعلام لكل طلب.
+
+REVOCATION_REFRESH_SECONDS = float(os.getenv("REVOCATION_REFRESH_SECONDS", "30"))
+
+_revoked_before: Dict[int, float] = {}
+_revocation_task: Optional[asyncio.Task] = None
+
+
+def _timestamp(value: datetime) -> float:
+    return calendar.timegm(value.utctimetuple()) + value.microsecond / 1_000_000
+
+
+def _is_revoked(user_id: int, claims: dict) -> bool:
+    revoked_before = _revoked_before.get(user_id)
+    if revoked_before is None:
+        return False
+    # الاثنين بالميكروثانية؛ نفس اللحظة بالضبط تعتبر ملغية. توكنات قديمة بدون iat
+    # تعتبر صادرة قبل أي إلغاء
+    return claims.get("iat", 0) <= revoked_before
+
+
+async def load_revocations() -> None:
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(select(TokenRevocation))
+        rows = result.scalars().all()
+    # revoke_user_tokens ممكن يشتغل أثناء الاستعلام؛ نأخذ الأحدث لكل مستخدم حتى
+    # الـ snapshot القديم ما يمسح إلغاء لسا صاير
+    for row in rows:
+        revoked_before = _timestamp(row.revoked_before)
+        if revoked_before > _revoked_before.get(row.user_id, 0.0):
+            _revoked_before[row.user_id] = revoked_before
+
+
+async def revoke_user_tokens(user_id: int, session: AsyncSession) -> None:
+    """Reject every token issued to ``user_id`` up to now.
+
+    Both the cutoff and ``iat`` have microsecond precision, so a token
+    issued right after this call stays valid. Call this when deleting a
+    user (or for "log out everywhere"). Other processes pick it up within
+    REVOCATION_REFRESH_SECONDS.
+    """
+    now = datetime.utcnow()
+    await session.merge(TokenRevocation(user_id=user_id, revoked_before=now))
+    await session.commit()
+    _revoked_before[user_id] = _timestamp(now)
+    invalidate_cached_user(user_id)
+
+
+async def _refresh_revocations() -> None:
+    while True:
+        await asyncio.sleep(REVOCATION_REFRESH_SECONDS)
+        try:
+            await load_revocations()
+        except Exception:
+            logger.exception("Could not refresh token revocations")
+
+
+async def start_revocation_refresh() -> None:
+    global _revocation_task
+    try:
+        await load_revocations()
+    except Exception:
+        # مثلًا الجدول لسا ما انعمل (migrations ما تطبقت)؛ التحديث الدوري يعيد المحاولة
+        logger.exception("Could not load token revocations")
+    if _revocation_task is None:
+        _revocation_task = asyncio.create_task(_refresh_revocations())
+
+
+async def stop_revocation_refresh() -> None:
+    global _revocation_task
+    if _revocation_task is not None:
+        _revocation_task.cancel()
+        try:
+            await _revocation_task
+        except asyncio.CancelledError:
+            pass
+        _revocation_task = None
+
+
+# ------------- Dependencies --------------
+
+@dataclass
+class Principal:
+    """The verified caller, taken from the token alone (no users query)."""
+
+    user_id: int
+    claims: dict = field(default_factory=dict)
+
+
+def _principal_from_token(token: Optional[str]) -> Optional[Principal]:
+    if not token:
+        return None
+    decoded = _decode_token(token)
+    if decoded is None:
+        return None
+    return Principal(*decoded)
+
+
+async def get_current_principal(token: str = Depends(oauth2_scheme)) -> Principal:
+    """Like ``get_current_user`` for routes that only need the user id."""
+    principal = _principal_from_token(token)
+    if principal is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Please log in again.",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return principal
+
+
+async def get_optional_principal(
+    token: Optional[str] = Depends(oauth2_scheme_optional),
+) -> Optional[Principal]:
+    """Returns the principal if logged in, or None if no token."""
+    return _principal_from_token(token)
+
+
+async def get_read_session(
+    principal: Optional[Principal] = Depends(get_optional_principal),
+) -> AsyncGenerator[AsyncSession, None]:
+    """Session for read-only routes: the read replica unless the caller just wrote."""
+    async with read_session(principal.user_id if principal else None) as session:
+        yield session
+
+
+def _credentials_exception() -> HTTPException:
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Please log in again.",
         headers={"WWW-Authenticate": "Bearer"},
     )
 
+
+async def get_current_user(
+    token: str = Depends(oauth2_scheme),
+    session: AsyncSession = Depends(get_session),
+) -> User:
     user = await _get_user_from_token(token, session)
     if user is None:
-        raise credentials_exception
-
+        raise _credentials_exception()
     return user
 
 
-async def get_optional_user(
-    token: Optional[str] = Depends(oauth2_scheme_optional),
-    session: AsyncSession = Depends(get_session),
-) -> Optional[User]:
-    """Returns the user if logged in, or None if no token."""
-    if not token:
-        return None
-    return await _get_user_from_token(token, session)
\ No newline at end of file
+async def get_current_user_readonly(
+    token: str = Depends(oauth2_scheme),
+    session: AsyncSession = Depends(get_read_session),
+) -> User:
+    """``get_current_user`` loaded from the read replica; don't modify the result."""
+    user = await _get_user_from_token(token, session)
+    if user is None and _decode_token(token) is not None:
+        # توكن صالح لمستخدم ما وصل الـ replica بعد (تسجيل جديد): نسأل الـ primary
+        async with AsyncSessionLocal() as primary:
+            user = await _get_user_from_token(token, primary)
+    if user is None:
+        raise _credentials_exception()
+    return user
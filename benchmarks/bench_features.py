@@ -0,0 +1,95 @@
+# benchmarks/bench_features.py
+#
+# يقيس تكلفة حساب خصائص الصورة لكل صورة: الطريقة القديمة (قوائم Python +
+# statistics.mean) مقابل image_features.py (NumPy)، ويتأكد إن النتائج متطابقة.
+#
+# التشغيل من جذر المشروع:
+#   python benchmarks/bench_features.py --images 20 --repeat 5
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from image_features import food_color_features, image_array, upper_half_luminance  # noqa: E402
+
+
+def legacy_upper_half_luminance(img: Image.Image) -> float:
+    w, h = img.size
+    upper = img.crop((0, 0, w, h // 2))
+    pixels = list(upper.getdata())
+    luminances = [sum(p) / 3 for p in pixels]
+    return statistics.mean(luminances)
+
+
+def legacy_channel_means(img: Image.Image):
+    pixels = list(img.getdata())
+    return (
+        statistics.mean([p[0] for p in pixels]),
+        statistics.mean([p[1] for p in pixels]),
+        statistics.mean([p[2] for p in pixels]),
+    )
+
+
+def synthetic_images(count: int, seed: int = 1234):
+    """Random 256 px photos (the size analysis works on after thumbnail)."""
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(count):
+        w, h = int(rng.integers(150, 257)), 256
+        data = rng.integers(0, 256, size=(h, w, 3), dtype=np.uint8)
+        images.append(Image.fromarray(data, "RGB"))
+    return images
+
+
+def _time_per_image(fn, images, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for img in images:
+            fn(img)
+        best = min(best, (time.perf_counter() - start) / len(images))
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Per-image cost of feature extraction")
+    parser.add_argument("--images", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    images = synthetic_images(args.images)
+
+    # تحقق من التطابق قبل القياس
+    for img in images:
+        arr = image_array(img)
+        assert abs(upper_half_luminance(arr) - legacy_upper_half_luminance(img)) < 1e-9
+        features = food_color_features(arr)
+        assert (features["avg_r"], features["avg_g"], features["avg_b"]) == legacy_channel_means(img)
+
+    def legacy_all(img):
+        legacy_upper_half_luminance(img)
+        legacy_channel_means(img)
+
+    def numpy_all(img):
+        arr = image_array(img)
+        upper_half_luminance(arr)
+        food_color_features(arr)
+
+    legacy = _time_per_image(legacy_all, images, args.repeat)
+    vectorized = _time_per_image(numpy_all, images, args.repeat)
+
+    print(f"images: {len(images)} (256 px), best of {args.repeat}")
+    print(f"legacy (lists + statistics): {legacy * 1000:8.3f} ms/image")
+    print(f"numpy  (image_features)    : {vectorized * 1000:8.3f} ms/image")
+    print(f"speedup                    : {legacy / vectorized:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+# benchmarks/bench_pipeline.py
+#
+# Micro-benchmark لمراحل تحليل الصور داخل العملية (بدون HTTP):
+# ingest -> decode -> thumbnail -> to_array -> features -> classify
+# لكل من مسار body و body-two و food، على صور اصطناعية ثابتة بعدة صيغ ودقّات.
+#
+# لكل مرحلة: الزمن (median و min على عدة تكرارات) وأعلى زيادة في الذاكرة.
+# الذاكرة تُقاس من VmHWM في /proc (Linux) لأن buffers الخاصة بـ PIL ما تظهر في
+# tracemalloc؛ على الأنظمة الثانية نرجع لـ tracemalloc (ذاكرة Python/NumPy فقط).
+#
+# أمثلة من جذر المشروع:
+#   python benchmarks/bench_pipeline.py
+#   python benchmarks/bench_pipeline.py --mp 0.3 12 --formats JPEG --pipelines food --repeat 10
+#   python benchmarks/bench_pipeline.py --output stages.json
+
+import argparse
+import io
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from typing import Callable, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# الصور الكبيرة (24 MP PNG) تتجاوز حدود الرفع الافتراضية؛ هنا نقيس المراحل فقط
+os.environ.setdefault("MAX_UPLOAD_BYTES", str(1024 * 1024 * 1024))
+os.environ.setdefault("MAX_IMAGE_PIXELS", str(200_000_000))
+
+from analysis import _decode, _reduce, classify_food, combine_body_two, score_body  # noqa: E402
+from image_features import food_color_features, image_array, upper_half_luminance  # noqa: E402
+from ingest import _ingest_file  # noqa: E402
+from synthetic_images import synthetic_upload  # noqa: E402
+
+
+def _read_status_kb(field: str) -> int:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    raise KeyError(field)
+
+
+def _proc_memory_available() -> bool:
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        _read_status_kb("VmHWM")
+        return True
+    except OSError:
+        return False
+
+
+class StageProbe:
+    """Runs pipeline stages, recording wall time and (optionally) peak memory."""
+
+    def __init__(self, measure_memory: bool, use_proc: bool) -> None:
+        self.measure_memory = measure_memory
+        self.use_proc = use_proc
+        self.seconds: Dict[str, float] = {}
+        self.peak_kb: Dict[str, int] = {}
+
+    def run(self, stage: str, fn: Callable, *args):
+        if not self.measure_memory:
+            start = time.perf_counter()
+            out = fn(*args)
+            self.seconds[stage] = time.perf_counter() - start
+            return out
+
+        if self.use_proc:
+            # تصفير الـ high-water mark ثم قراءة أعلى RSS وصلته المرحلة
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+            before = _read_status_kb("VmRSS")
+            out = fn(*args)
+            self.peak_kb[stage] = max(0, _read_status_kb("VmHWM") - before)
+        else:
+            tracemalloc.start()
+            out = fn(*args)
+            self.peak_kb[stage] = tracemalloc.get_traced_memory()[1] // 1024
+            tracemalloc.stop()
+        return out
+
+
+# ------------- Pipelines --------------
+
+def _photo_stages(probe: StageProbe, data: bytes, prefix: str = ""):
+    ingested = probe.run(prefix + "ingest", _ingest_file, io.BytesIO(data))
+    img, orientation = probe.run(prefix + "decode", _decode, ingested.file)
+    img = probe.run(prefix + "thumbnail", _reduce, img, orientation)
+    arr = probe.run(prefix + "to_array", image_array, img)
+    return img, arr
+
+
+def body_pipeline(probe: StageProbe, data: bytes, _side: bytes) -> None:
+    img, arr = _photo_stages(probe, data)
+    w, h = img.size
+    avg_lum = probe.run("features", upper_half_luminance, arr)
+    probe.run("classify", score_body, avg_lum, round(h / w, 3))
+
+
+def body_two_pipeline(probe: StageProbe, front: bytes, side: bytes) -> None:
+    features = []
+    for prefix, data in (("front_", front), ("side_", side)):
+        img, arr = _photo_stages(probe, data, prefix)
+        w, h = img.size
+        avg_lum = probe.run(prefix + "features", upper_half_luminance, arr)
+        features.append((avg_lum, round(h / w, 3)))
+    probe.run("combine", combine_body_two, features[0], features[1])
+
+
+def food_pipeline(probe: StageProbe, data: bytes, _side: bytes) -> None:
+    _img, arr = _photo_stages(probe, data)
+    features = probe.run("features", food_color_features, arr)
+    probe.run("classify", classify_food, features)
+
+
+PIPELINES = {
+    "body": body_pipeline,
+    "body_two": body_two_pipeline,
+    "food": food_pipeline,
+}
+
+
+def bench_case(pipeline: Callable, front: bytes, side: bytes, repeat: int, use_proc: bool) -> dict:
+    samples: Dict[str, List[float]] = defaultdict(list)
+    totals: List[float] = []
+
+    pipeline(StageProbe(False, use_proc), front, side)  # تسخين
+    for _ in range(repeat):
+        probe = StageProbe(False, use_proc)
+        start = time.perf_counter()
+        pipeline(probe, front, side)
+        totals.append(time.perf_counter() - start)
+        for stage, seconds in probe.seconds.items():
+            samples[stage].append(seconds)
+
+    memory = StageProbe(True, use_proc)
+    pipeline(memory, front, side)
+
+    stages = {
+        stage: {
+            "median_ms": round(statistics.median(values) * 1000, 3),
+            "min_ms": round(min(values) * 1000, 3),
+            "peak_kb": memory.peak_kb.get(stage, 0),
+        }
+        for stage, values in samples.items()
+    }
+    return {
+        "total_median_ms": round(statistics.median(totals) * 1000, 3),
+        "total_min_ms": round(min(totals) * 1000, 3),
+        "stages": stages,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Per-stage timings of the image analysis pipelines")
+    parser.add_argument("--mp", type=float, nargs="+", default=[0.3, 2.0, 12.0, 24.0],
+                        help="megapixels of the synthetic photos")
+    parser.add_argument("--formats", nargs="+", default=["JPEG", "PNG", "WEBP"])
+    parser.add_argument("--pipelines", nargs="+", choices=sorted(PIPELINES), default=list(PIPELINES))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", default="", help="write the JSON report here")
+    args = parser.parse_args()
+
+    use_proc = _proc_memory_available()
+    memory_source = "proc VmHWM (RSS)" if use_proc else "tracemalloc (Python/NumPy only)"
+
+    report = {
+        "config": {
+            "megapixels": args.mp,
+            "formats": args.formats,
+            "repeat": args.repeat,
+            "memory_source": memory_source,
+        },
+        "cases": [],
+    }
+
+    print(f"memory: {memory_source}")
+    for fmt in args.formats:
+        for mp in args.mp:
+            front = synthetic_upload(mp, fmt, seed=1)
+            side = synthetic_upload(mp, fmt, seed=2)
+            for name in args.pipelines:
+                result = bench_case(PIPELINES[name], front, side, args.repeat, use_proc)
+                result.update({
+                    "pipeline": name,
+                    "format": fmt,
+                    "megapixels": mp,
+                    "upload_kb": len(front) // 1024,
+                })
+                report["cases"].append(result)
+
+                print(f"\n{name} {fmt} {mp} MP ({len(front) // 1024} KB): "
+                      f"total {result['total_median_ms']:.2f} ms")
+                for stage, s in result["stages"].items():
+                    print(f"  {stage:18} {s['median_ms']:9.3f} ms  (min {s['min_ms']:8.3f})"
+                          f"  peak {s['peak_kb']:8d} KB")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,365 @@
+# benchmarks/load_test.py
+#
+# اختبار حمل كامل للـ API: يشغّل تطبيق FastAPI داخل نفس العملية على قاعدة SQLite
+# محلية (aiosqlite)، يزرع مستخدمين وتاريخ، ثم يرسل خليط واقعي من الطلبات
+# بتوازي محدد، ويكتب throughput و p50/p95/p99 لكل مسار في ملف JSON.
+#
+# يحتاج httpx (pip install httpx).
+#
+# أمثلة من جذر المشروع:
+#   python benchmarks/load_test.py --duration 30 --concurrency 16 --output bench.json
+#   python benchmarks/load_test.py --mix "food=5,food_history=3,login=1" --requests 2000
+#   python benchmarks/load_test.py --output new.json --baseline bench.json --tolerance 0.15
+#
+# الصور المرفوعة قليلة (وحدة لكل --image-mp)، فكاش نتائج التحليل يطفى افتراضيًا
+# وإلا كل طلب تحليل بعد التسخين يصير cache hit. --cache يرجعه (لقياس الكاش نفسه).
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_MIX = {
+    "register": 1,
+    "login": 2,
+    "me": 3,
+    "body": 2,
+    "body_two": 1,
+    "food": 3,
+    "body_history": 4,
+    "food_history": 4,
+    "subscription": 4,
+    "workout_plan_write": 1,
+    "meal_plan_write": 1,
+    "workout_plan_read": 2,
+    "meal_plan_read": 2,
+}
+
+SEED_PASSWORD = "bench-password-123"
+
+
+def parse_mix(value: str) -> Dict[str, int]:
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"unknown operation {name!r}")
+        mix[name] = int(weight or 1)
+    return mix
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100 * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+class Recorder:
+    def __init__(self) -> None:
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.statuses: Dict[str, Dict[int, int]] = defaultdict(lambda: defaultdict(int))
+
+    def record(self, route: str, status_code: int, seconds: float) -> None:
+        self.latencies[route].append(seconds)
+        self.statuses[route][status_code] += 1
+
+    def report(self, elapsed: float) -> dict:
+        routes = {}
+        all_latencies = []
+        for route, values in sorted(self.latencies.items()):
+            values.sort()
+            all_latencies.extend(values)
+            errors = sum(n for code, n in self.statuses[route].items() if code >= 400)
+            routes[route] = self._summary(values, elapsed)
+            routes[route]["errors"] = errors
+            routes[route]["status_codes"] = {str(k): v for k, v in sorted(self.statuses[route].items())}
+        all_latencies.sort()
+        return {"overall": self._summary(all_latencies, elapsed), "routes": routes}
+
+    @staticmethod
+    def _summary(values: List[float], elapsed: float) -> dict:
+        return {
+            "requests": len(values),
+            "throughput_rps": round(len(values) / elapsed, 2) if elapsed else 0.0,
+            "p50_ms": round(percentile(values, 50) * 1000, 3),
+            "p95_ms": round(percentile(values, 95) * 1000, 3),
+            "p99_ms": round(percentile(values, 99) * 1000, 3),
+            "max_ms": round((values[-1] if values else 0.0) * 1000, 3),
+        }
+
+
+class LoadTest:
+    def __init__(self, client, users: List[dict], images: Dict[str, List[bytes]], rng: random.Random):
+        self.client = client
+        self.users = users
+        self.images = images
+        self.rng = rng
+        self.recorder = Recorder()
+
+    async def _call(self, route: str, method: str, url: str, **kwargs) -> None:
+        start = time.perf_counter()
+        response = await self.client.request(method, url, **kwargs)
+        self.recorder.record(route, response.status_code, time.perf_counter() - start)
+
+    def _auth(self) -> dict:
+        user = self.rng.choice(self.users)
+        return {"Authorization": f"Bearer {user['token']}"}
+
+    def _image(self) -> bytes:
+        return self.rng.choice(self.images["jpeg"])
+
+    async def run_operation(self, name: str) -> None:
+        if name == "register":
+            await self._call("POST /auth/register", "POST", "/auth/register", json={
+                "email": f"bench-{uuid.uuid4().hex}@example.com",
+                "password": SEED_PASSWORD,
+                "full_name": "Bench User",
+            })
+        elif name == "login":
+            user = self.rng.choice(self.users)
+            await self._call("POST /auth/login", "POST", "/auth/login", data={
+                "username": user["email"],
+                "password": SEED_PASSWORD,
+            })
+        elif name == "me":
+            await self._call("GET /users/me", "GET", "/users/me", headers=self._auth())
+        elif name == "body":
+            await self._call(
+                "POST /analysis/body", "POST", "/analysis/body",
+                headers=self._auth(),
+                files={"file": ("body.jpg", self._image(), "image/jpeg")},
+                data={"language": "en"},
+            )
+        elif name == "body_two":
+            await self._call(
+                "POST /analysis/body-two", "POST", "/analysis/body-two",
+                headers=self._auth(),
+                files={
+                    "front_file": ("front.jpg", self._image(), "image/jpeg"),
+                    "side_file": ("side.jpg", self._image(), "image/jpeg"),
+                },
+                data={"language": "en"},
+            )
+        elif name == "food":
+            await self._call(
+                "POST /analysis/food", "POST", "/analysis/food",
+                headers=self._auth(),
+                files={"file": ("meal.jpg", self._image(), "image/jpeg")},
+                data={"language": "en", "cuisine": "general"},
+            )
+        elif name == "body_history":
+            await self._call("GET /analysis/body/history", "GET", "/analysis/body/history", headers=self._auth())
+        elif name == "food_history":
+            await self._call("GET /analysis/food/history", "GET", "/analysis/food/history", headers=self._auth())
+        elif name == "subscription":
+            await self._call("GET /subscriptions/me", "GET", "/subscriptions/me", headers=self._auth())
+        elif name == "workout_plan_write":
+            await self._call("POST /plans/workout", "POST", "/plans/workout", headers=self._auth(), json={
+                "duration_weeks": self.rng.randint(4, 12),
+                "focus": self.rng.choice(["strength", "cardio", "mobility"]),
+            })
+        elif name == "meal_plan_write":
+            await self._call("POST /plans/meal", "POST", "/plans/meal", headers=self._auth(), json={
+                "calories_target": self.rng.randint(1600, 3000),
+                "protein": 140,
+                "carbs": 220,
+                "fats": 70,
+            })
+        elif name == "workout_plan_read":
+            await self._call("GET /plans/workout/current", "GET", "/plans/workout/current", headers=self._auth())
+        elif name == "meal_plan_read":
+            await self._call("GET /plans/meal/current", "GET", "/plans/meal/current", headers=self._auth())
+
+    async def worker(self, mix: Dict[str, int], deadline: Optional[float], budget: List[int]) -> None:
+        names = list(mix)
+        weights = [mix[n] for n in names]
+        while True:
+            if deadline is not None and time.perf_counter() >= deadline:
+                return
+            if budget[0] <= 0:
+                return
+            budget[0] -= 1
+            await self.run_operation(self.rng.choices(names, weights)[0])
+
+
+async def seed(users: int, history_per_user: int, rng: random.Random) -> List[dict]:
+    from auth_utils import create_access_token, get_password_hash
+    from db import AsyncSessionLocal
+    from models import BodyAnalysis, FoodAnalysis, User
+
+    hashed = get_password_hash(SEED_PASSWORD)
+    seeded = []
+    async with AsyncSessionLocal() as session:
+        rows = [
+            User(email=f"seed-{i}@example.com", hashed_password=hashed, full_name=f"Seed {i}")
+            for i in range(users)
+        ]
+        session.add_all(rows)
+        await session.commit()
+
+        history = []
+        for user in rows:
+            for _ in range(history_per_user):
+                history.append(BodyAnalysis(
+                    user_id=user.id, shape="Balanced", body_fat=rng.uniform(12, 28),
+                    muscle_mass=rng.uniform(30, 50), bmi=rng.uniform(19, 30), aspect_ratio=1.33,
+                ))
+                history.append(FoodAnalysis(
+                    user_id=user.id, meal_name="Moderate-calorie meal",
+                    calories=550, protein=25, carbs=60, fats=18,
+                ))
+            seeded.append({
+                "id": user.id,
+                "email": user.email,
+                "token": create_access_token({"sub": str(user.id)}),
+            })
+        session.add_all(history)
+        await session.commit()
+    return seeded
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Routes whose p95 grew or throughput dropped by more than ``tolerance``."""
+    regressions = []
+    for route, current in report["routes"].items():
+        previous = baseline.get("routes", {}).get(route)
+        if not previous or not previous["requests"]:
+            continue
+        if previous["p95_ms"] and current["p95_ms"] > previous["p95_ms"] * (1 + tolerance):
+            regressions.append(
+                f"{route}: p95 {previous['p95_ms']:.1f} -> {current['p95_ms']:.1f} ms"
+            )
+        if previous["throughput_rps"] and current["throughput_rps"] < previous["throughput_rps"] * (1 - tolerance):
+            regressions.append(
+                f"{route}: throughput {previous['throughput_rps']:.1f} -> {current['throughput_rps']:.1f} rps"
+            )
+    return regressions
+
+
+async def run(args) -> dict:
+    try:
+        import httpx
+    except ImportError:
+        sys.exit("load_test.py needs httpx: pip install httpx")
+
+    from synthetic_images import synthetic_upload
+
+    import main
+
+    rng = random.Random(args.seed)
+    images = {
+        "jpeg": [synthetic_upload(mp, "JPEG", seed=i) for i, mp in enumerate(args.image_mp)],
+    }
+
+    async with main.app.router.lifespan_context(main.app):
+        users = await seed(args.users, args.history, rng)
+
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            test = LoadTest(client, users, images, rng)
+
+            # تسخين: مرة وحدة لكل عملية حتى ما تدخل تكلفة أول استدعاء في القياس
+            for name in args.mix:
+                await test.run_operation(name)
+            test.recorder = Recorder()
+
+            budget = [args.requests if args.requests else float("inf")]
+            deadline = time.perf_counter() + args.duration if not args.requests else None
+            start = time.perf_counter()
+            await asyncio.gather(*(test.worker(args.mix, deadline, budget) for _ in range(args.concurrency)))
+            elapsed = time.perf_counter() - start
+
+    report = test.recorder.report(elapsed)
+    report["config"] = {
+        "concurrency": args.concurrency,
+        "duration_s": round(elapsed, 3),
+        "mix": args.mix,
+        "users": args.users,
+        "history_per_user": args.history,
+        "image_mp": args.image_mp,
+        "seed": args.seed,
+        "analysis_cache": args.cache,
+        "database_url": os.environ["DATABASE_URL"],
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+    }
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="In-process load test for the BodyTalk API")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds (ignored with --requests)")
+    parser.add_argument("--requests", type=int, default=0, help="stop after this many requests")
+    parser.add_argument("--mix", type=parse_mix, default=dict(DEFAULT_MIX),
+                        help="weights, e.g. 'food=3,food_history=2,login=1'")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--history", type=int, default=20, help="seeded rows per user and table")
+    parser.add_argument("--image-mp", type=float, nargs="+", default=[0.3, 3.0, 12.0],
+                        help="megapixels of the synthetic upload photos")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--cache", action="store_true",
+                        help="keep the analysis result cache on (repeat uploads become cache hits)")
+    parser.add_argument("--database-url", default="",
+                        help="defaults to a fresh SQLite file in a temp directory")
+    parser.add_argument("--output", default="", help="write the JSON report here")
+    parser.add_argument("--baseline", default="", help="JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed relative p95/throughput regression vs the baseline")
+    args = parser.parse_args()
+
+    # لازم يتضبط قبل import db/main لأن الـ engine يتبنى وقت الاستيراد
+    os.environ["DATABASE_URL"] = args.database_url or (
+        "sqlite+aiosqlite:///" + os.path.join(tempfile.mkdtemp(prefix="bodytalk-bench-"), "bench.db")
+    )
+
+    if not args.cache:
+        # بدونها الأرقام تقيس الكاش وليس decode/features
+        os.environ["ANALYSIS_CACHE_SIZE"] = "0"
+
+    report = asyncio.run(run(args))
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+    print(f"{'route':34} {'reqs':>7} {'rps':>8} {'p50':>9} {'p95':>9} {'p99':>9} {'err':>5}")
+    for route, r in report["routes"].items():
+        print(
+            f"{route:34} {r['requests']:7d} {r['throughput_rps']:8.1f} "
+            f"{r['p50_ms']:9.1f} {r['p95_ms']:9.1f} {r['p99_ms']:9.1f} {r['errors']:5d}"
+        )
+    o = report["overall"]
+    print(f"{'overall':34} {o['requests']:7d} {o['throughput_rps']:8.1f} "
+          f"{o['p50_ms']:9.1f} {o['p95_ms']:9.1f} {o['p99_ms']:9.1f}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            print("\nRegressions vs baseline:")
+            for line in regressions:
+                print("  " + line)
+            sys.exit(1)
+        print("\nNo regressions vs baseline.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+# benchmarks/synthetic_images.py
+#
+# صور اصطناعية ثابتة (deterministic) تشبه صور الكاميرا: تدرجات ناعمة + ضوضاء،
+# حتى يكون حجم الملف بعد الضغط وزمن فك الترميز قريب من الصور الحقيقية.
+
+import io
+from typing import Tuple
+
+import numpy as np
+from PIL import Image
+
+
+def synthetic_photo(width: int, height: int, seed: int = 0) -> Image.Image:
+    rng = np.random.default_rng(seed)
+
+    # تدرجات منخفضة الدقة تتكبر لتعطي مساحات لونية ناعمة
+    coarse = rng.integers(0, 256, size=(max(2, height // 64), max(2, width // 64), 3), dtype=np.uint8)
+    base = np.asarray(
+        Image.fromarray(coarse, "RGB").resize((width, height), Image.Resampling.BILINEAR),
+        dtype=np.int16,
+    )
+
+    noise = rng.integers(-12, 13, size=(height, width, 1), dtype=np.int16)
+    pixels = np.clip(base + noise, 0, 255).astype(np.uint8)
+    return Image.fromarray(pixels, "RGB")
+
+
+def encode(img: Image.Image, fmt: str = "JPEG", quality: int = 90) -> bytes:
+    buf = io.BytesIO()
+    if fmt.upper() in ("JPEG", "WEBP"):
+        img.save(buf, fmt, quality=quality)
+    else:
+        img.save(buf, fmt)
+    return buf.getvalue()
+
+
+def megapixel_size(megapixels: float, aspect: Tuple[int, int] = (3, 4)) -> Tuple[int, int]:
+    """(width, height) with roughly ``megapixels`` MP and the given w:h aspect."""
+    aw, ah = aspect
+    unit = (megapixels * 1_000_000 / (aw * ah)) ** 0.5
+    return int(aw * unit), int(ah * unit)
+
+
+def synthetic_upload(megapixels: float, fmt: str = "JPEG", seed: int = 0) -> bytes:
+    width, height = megapixel_size(megapixels)
+    return encode(synthetic_photo(width, height, seed), fmt)
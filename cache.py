@@ -0,0 +1,191 @@
+# cache.py
+#
+# كاش بسيط في الذاكرة (LRU + TTL) مع عدادات hit/miss،
+# وكاش نتائج التحليل المبني عليه (مفتاحه hash محتوى الصورة).
+
+import asyncio
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Hashable, Iterable, Optional
+
+
+class LRUCache:
+    """Bounded in-memory cache with LRU eviction and a per-entry TTL.
+
+    Only touched from the event loop thread, so no locking is needed.
+    ``max_entries <= 0`` disables the cache (every lookup is a miss).
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float) -> None:
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl_seconds: Optional[float] = None) -> None:
+        if not self.enabled:
+            return
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+# ------------- Analysis Result Cache --------------
+
+# عدد النتائج في الذاكرة (0 = تعطيل الكاش)
+ANALYSIS_CACHE_SIZE = int(os.getenv("ANALYSIS_CACHE_SIZE", "2048"))
+ANALYSIS_CACHE_TTL = float(os.getenv("ANALYSIS_CACHE_TTL", str(24 * 60 * 60)))
+# ملف SQLite اختياري حتى يبقى الكاش بعد إعادة التشغيل (فاضي = ذاكرة فقط)
+ANALYSIS_CACHE_PATH = os.getenv("ANALYSIS_CACHE_PATH", "")
+
+# كل كم عملية كتابة نحذف النتائج المنتهية من الملف
+_DISK_PURGE_EVERY = 256
+
+
+def analysis_cache_key(
+    endpoint: str,
+    digests: Iterable[str],
+    language: str,
+    cuisine: Optional[str] = None,
+) -> str:
+    return "|".join([endpoint, *digests, language, cuisine or ""])
+
+
+class AnalysisResultCache(LRUCache):
+    """LRU/TTL cache for analysis results, optionally backed by a SQLite file.
+
+    The memory tier is checked first; on a miss ``aget`` consults the disk
+    tier and a hit there is promoted back into memory. All disk I/O runs on
+    one dedicated thread, so the event loop never waits on SQLite.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float, path: str = "") -> None:
+        super().__init__(max_entries, ttl_seconds)
+        self.disk_hits = 0
+        self._writes = 0
+        self._db: Optional[sqlite3.Connection] = None
+        self._disk: Optional[ThreadPoolExecutor] = None
+        if path and self.enabled:
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            # الكاش ينبني من جديد لو ضاع، فما نحتاج fsync مع كل كتابة
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS analysis_cache ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            # thread واحد: الكتابة بالترتيب، والقراءة تشوف كل كتابة قبلها
+            self._disk = ThreadPoolExecutor(max_workers=1, thread_name_prefix="analysis-cache")
+
+    async def aget(self, key: str) -> Optional[Any]:
+        value = self.get(key)
+        if value is not None or self._disk is None:
+            return value
+
+        loop = asyncio.get_running_loop()
+        row = await loop.run_in_executor(self._disk, self._disk_get, key)
+        if row is None or row[1] < time.time():
+            return None
+
+        value = json.loads(row[0])
+        # الطلب انحسب miss في الذاكرة لكنه hit فعليًا
+        self.misses -= 1
+        self.hits += 1
+        self.disk_hits += 1
+        super().set(key, value, ttl_seconds=row[1] - time.time())
+        return value
+
+    def set(self, key: str, value: Any, ttl_seconds: Optional[float] = None) -> None:
+        super().set(key, value, ttl_seconds)
+        if self._disk is None:
+            return
+
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        # ما ننتظر الكتابة؛ الـ thread يكتبها بالخلفية
+        self._disk.submit(self._disk_set, key, json.dumps(value), time.time() + ttl)
+
+    def _disk_get(self, key: str) -> Optional[tuple]:
+        return self._db.execute(
+            "SELECT value, expires_at FROM analysis_cache WHERE key = ?", (key,)
+        ).fetchone()
+
+    def _disk_set(self, key: str, value: str, expires_at: float) -> None:
+        self._db.execute(
+            "INSERT OR REPLACE INTO analysis_cache (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, value, expires_at),
+        )
+        self._writes += 1
+        if self._writes % _DISK_PURGE_EVERY == 0:
+            self._db.execute("DELETE FROM analysis_cache WHERE expires_at < ?", (time.time(),))
+
+    def stats(self) -> dict:
+        data = super().stats()
+        data["disk_enabled"] = self._db is not None
+        data["disk_hits"] = self.disk_hits
+        return data
+
+    def close(self) -> None:
+        if self._disk is not None:
+            # ننتظر الكتابات المعلقة قبل ما نسكر الملف
+            self._disk.shutdown(wait=True)
+            self._disk = None
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+analysis_cache = AnalysisResultCache(
+    ANALYSIS_CACHE_SIZE,
+    ANALYSIS_CACHE_TTL,
+    ANALYSIS_CACHE_PATH,
+)
@@ -1,7 +1,12 @@
 # db.py
+import asyncio
 import os
-from typing import AsyncGenerator
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncGenerator, AsyncIterator, Dict, Optional
 
+from sqlalchemy import event, text
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.ext.asyncio import (
     AsyncSession,
     async_sessionmaker,
@@ -21,18 +26,159 @@ DATABASE_URL = os.getenv(
 if DATABASE_URL.startswith("postgresql://"):
     DATABASE_URL = DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://", 1)
 
+# sqlite+aiosqlite:///./bodytalk_local.db -> وضع SQLite (نشر على سيرفر واحد، benchmarks)
+IS_SQLITE = DATABASE_URL.startswith("sqlite")
+
+# ---------------- Connection Pool ----------------
+# كل worker في uvicorn عنده pool خاص فيه، فالحد الأعلى للاتصالات =
+# workers × (DB_POOL_SIZE + DB_MAX_OVERFLOW) ولازم يكون أقل من حد Postgres.
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+# كم ثانية ينتظر الطلب اتصال فاضي قبل ما يفشل
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+# إعادة فتح الاتصال بعد هالمدة (ثواني) حتى ما نستخدم اتصال قطعه السيرفر وهو خامل
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+# فحص الاتصال قبل استخدامه (round trip صغير مقابل عدم فشل أول طلب بعد الخمول)
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+# أقصى زمن لأي جملة SQL بالميلي ثانية (0 = بدون حد). Postgres فقط
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "15000"))
+# أقصى زمن لفتح اتصال جديد بالثواني
+DB_CONNECT_TIMEOUT = float(os.getenv("DB_CONNECT_TIMEOUT", "10"))
+
+
+def _engine_options(url: str) -> dict:
+    options = {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+    if url.startswith("postgresql+asyncpg"):
+        connect_args = {"timeout": DB_CONNECT_TIMEOUT}
+        if DB_STATEMENT_TIMEOUT_MS > 0:
+            # السيرفر يلغي الجملة بنفسه، فالاتصال يرجع للـ pool سليم
+            connect_args["server_settings"] = {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}
+        options["connect_args"] = connect_args
+    elif url.startswith("sqlite"):
+        if ":memory:" in url or "mode=memory" in url:
+            # قاعدة في الذاكرة تستخدم StaticPool (اتصال واحد) وما تقبل إعدادات الـ pool
+            return {}
+        # مدة انتظار القفل؛ PRAGMA busy_timeout تحت تضبطها لكل اتصال
+        options["connect_args"] = {"timeout": SQLITE_BUSY_TIMEOUT_MS / 1000}
+    return options
+
+
+# ---------------- SQLite Tuning ----------------
+
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+# حجم كاش الصفحات لكل اتصال (KiB)
+SQLITE_CACHE_KB = int(os.getenv("SQLITE_CACHE_KB", str(64 * 1024)))
+# حجم الـ memory map (bytes)؛ القراءة من الـ page cache بدون نسخ
+SQLITE_MMAP_BYTES = int(os.getenv("SQLITE_MMAP_BYTES", str(256 * 1024 * 1024)))
+# NORMAL مع WAL: ما يخسر بيانات إلا لو انقطعت الكهرباء عن الجهاز نفسه
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL").upper()
+
+SQLITE_PRAGMAS = (
+    # WAL: القراء ما ينتظرون الكاتب والعكس
+    "PRAGMA journal_mode=WAL",
+    f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}",
+    f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}",
+    f"PRAGMA cache_size=-{SQLITE_CACHE_KB}",
+    f"PRAGMA mmap_size={SQLITE_MMAP_BYTES}",
+    "PRAGMA temp_store=MEMORY",
+)
+
+
+def _apply_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    try:
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+    finally:
+        cursor.close()
+
+
+# SQLite يسمح بكاتب واحد بس. بدون ترتيب، commits المتزامنة تتسابق على القفل
+# (وترقية قراءة لكتابة داخل transaction ممكن تفشل فورًا بـ "database is locked").
+# فنمرر الكتابة عبر قفل واحد للـ process: الجلسة تاخذه أول ما تكتب وتتركه بعد
+# commit/rollback، والقراءة ما تمر عليه أبدًا.
+
+_writer_lock: Optional[asyncio.Lock] = None
+
+
+def _get_writer_lock() -> asyncio.Lock:
+    global _writer_lock
+    if _writer_lock is None:
+        _writer_lock = asyncio.Lock()
+    return _writer_lock
+
+
+class SQLiteSession(AsyncSession):
+    """AsyncSession that holds the process-wide writer lock while it writes."""
+
+    _holds_writer = False
+
+    def _has_pending(self) -> bool:
+        return bool(self.new or self.dirty or self.deleted)
+
+    async def _acquire_writer(self) -> None:
+        if not self._holds_writer:
+            await _get_writer_lock().acquire()
+            self._holds_writer = True
+
+    def _release_writer(self) -> None:
+        if self._holds_writer:
+            self._holds_writer = False
+            _get_writer_lock().release()
+
+    async def execute(self, statement, *args, **kwargs):
+        # INSERT/UPDATE/DELETE، أو SELECT راح يعمل autoflush لتعديلات معلقة
+        if getattr(statement, "is_dml", False) or self._has_pending():
+            await self._acquire_writer()
+        return await super().execute(statement, *args, **kwargs)
+
+    async def flush(self, objects=None) -> None:
+        if self._has_pending():
+            await self._acquire_writer()
+        await super().flush(objects)
+
+    async def commit(self) -> None:
+        if self._has_pending():
+            await self._acquire_writer()
+        try:
+            await super().commit()
+        finally:
+            self._release_writer()
+
+    async def rollback(self) -> None:
+        try:
+            await super().rollback()
+        finally:
+            self._release_writer()
+
+    async def close(self) -> None:
+        try:
+            await super().close()
+        finally:
+            self._release_writer()
 
 
 engine = create_async_engine(
     DATABASE_URL,
     echo=False,      # خليها True لو حاب تشوف SQL في التيرمنال
     future=True,
+    **_engine_options(DATABASE_URL),
 )
 
+if IS_SQLITE:
+    event.listen(engine.sync_engine, "connect", _apply_sqlite_pragmas)
+
 AsyncSessionLocal = async_sessionmaker(
     engine,
     expire_on_commit=False,
-    class_=AsyncSession,
+    class_=SQLiteSession if IS_SQLITE else AsyncSession,
 )
 
 
@@ -46,3 +192,235 @@ async def get_session() -> AsyncGenerator[AsyncSession, None]:
             yield session
         finally:
             await session.close()
+
+
+# ---------------- Read Replica ----------------
+# اختياري: DATABASE_READ_URL يشير لـ replica (streaming replication) والمسارات
+# اللي تقرأ بس (السجل، الاشتراك، الخطة الحالية، /users/me) تروح لها بدل الـ primary.
+#
+# الـ replica متأخرة شوي، فالمستخدم اللي كتب للتو يقرأ من الـ primary لمدة
+# READ_YOUR_WRITES_SECONDS (read-your-writes). النافذة محفوظة في ذاكرة الـ process،
+# فمع عدة workers الطلب التالي ممكن يوصل worker ثاني؛ هناك أقصى قدم للبيانات هو
+# READ_REPLICA_MAX_LAG_SECONDS، فخلي النافذة أطول منه.
+#
+# لو الـ replica ما ترد، أو متأخرة أكثر من الحد، كل القراءة ترجع للـ primary
+# تلقائيًا لين ينجح الفحص التالي.
+
+DATABASE_READ_URL = os.getenv("DATABASE_READ_URL", "")
+if DATABASE_READ_URL.startswith("postgresql://"):
+    DATABASE_READ_URL = DATABASE_READ_URL.replace("postgresql://", "postgresql+asyncpg://", 1)
+
+# مدة القراءة من الـ primary بعد ما يكتب المستخدم (ثواني)
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "5"))
+# أقصى تأخير replication مقبول قبل ما نرجع للـ primary (ثواني). Postgres فقط
+READ_REPLICA_MAX_LAG_SECONDS = float(os.getenv("READ_REPLICA_MAX_LAG_SECONDS", "2"))
+# كل كم ثانية نفحص الـ replica
+READ_REPLICA_CHECK_SECONDS = float(os.getenv("READ_REPLICA_CHECK_SECONDS", "5"))
+
+read_engine = (
+    create_async_engine(
+        DATABASE_READ_URL,
+        echo=False,
+        future=True,
+        **_engine_options(DATABASE_READ_URL),
+    )
+    if DATABASE_READ_URL
+    else None
+)
+
+if read_engine is not None and DATABASE_READ_URL.startswith("sqlite"):
+    event.listen(read_engine.sync_engine, "connect", _apply_sqlite_pragmas)
+
+ReadSessionLocal = (
+    async_sessionmaker(read_engine, expire_on_commit=False)
+    if read_engine is not None
+    else None
+)
+
+# 0 على الـ primary؛ على الـ standby: عمر آخر transaction تطبقت، إلا لو طبقت كل
+# اللي وصلها (primary خامل) فما في تأخير فعلي
+_REPLICA_LAG_SQL = text(
+    "SELECT CASE "
+    "WHEN NOT pg_is_in_recovery() THEN 0 "
+    "WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) "
+    "END"
+)
+
+_recent_writers: Dict[int, float] = {}
+# None = لسا ما انفحصت، فالقراءة على الـ primary
+_replica_result: Optional[dict] = None
+_replica_checked_at = 0.0
+_replica_check_task: Optional[asyncio.Task] = None
+_read_stats = {"replica_reads": 0, "primary_reads": 0, "read_your_writes": 0, "fallbacks": 0}
+
+
+def note_user_write(user_id: Optional[int]) -> None:
+    """Route this user's reads to the primary for READ_YOUR_WRITES_SECONDS."""
+    if read_engine is None or user_id is None:
+        return
+    now = time.monotonic()
+    if len(_recent_writers) > 10_000:
+        for uid, until in list(_recent_writers.items()):
+            if until <= now:
+                del _recent_writers[uid]
+    _recent_writers[user_id] = now + READ_YOUR_WRITES_SECONDS
+
+
+def _wrote_recently(user_id: Optional[int]) -> bool:
+    if user_id is None:
+        return False
+    until = _recent_writers.get(user_id)
+    if until is None:
+        return False
+    if until <= time.monotonic():
+        _recent_writers.pop(user_id, None)
+        return False
+    return True
+
+
+async def _probe_replica() -> dict:
+    start = time.perf_counter()
+    try:
+        async with read_engine.connect() as conn:
+            if conn.dialect.name == "postgresql":
+                lag = float(await conn.scalar(_REPLICA_LAG_SQL) or 0)
+            else:
+                await conn.execute(text("SELECT 1"))
+                lag = 0.0
+    except Exception as e:
+        return {"status": "error", "detail": str(e)}
+    result = {
+        "status": "ok",
+        "latency_ms": round((time.perf_counter() - start) * 1000, 2),
+        "lag_seconds": round(lag, 3),
+    }
+    if lag > READ_REPLICA_MAX_LAG_SECONDS:
+        result["status"] = "lagging"
+    return result
+
+
+async def _refresh_replica_health() -> None:
+    global _replica_result, _replica_checked_at, _replica_check_task
+    try:
+        _replica_result = await _probe_replica()
+        _replica_checked_at = time.monotonic()
+    finally:
+        _replica_check_task = None
+
+
+def _replica_usable() -> bool:
+    """Last known replica state; a stale one is re-checked in the background."""
+    global _replica_check_task
+    if read_engine is None:
+        return False
+    stale = time.monotonic() - _replica_checked_at >= READ_REPLICA_CHECK_SECONDS
+    if stale and _replica_check_task is None:
+        # الطلب ما ينتظر الفحص (ممكن ياخذ DB_CONNECT_TIMEOUT لو الـ replica واقفة)
+        _replica_check_task = asyncio.create_task(_refresh_replica_health())
+    return _replica_result is not None and _replica_result["status"] == "ok"
+
+
+def _mark_replica_down(error: Exception) -> None:
+    global _replica_result, _replica_checked_at
+    _replica_result = {"status": "error", "detail": str(error)}
+    _replica_checked_at = time.monotonic()
+
+
+def read_session_for(user_id: Optional[int]) -> AsyncSession:
+    """A session for read-only queries: the replica when it's safe, else the primary."""
+    if read_engine is None:
+        return AsyncSessionLocal()
+    if _wrote_recently(user_id):
+        _read_stats["read_your_writes"] += 1
+    elif _replica_usable():
+        _read_stats["replica_reads"] += 1
+        return ReadSessionLocal()
+    else:
+        _read_stats["fallbacks"] += 1
+    _read_stats["primary_reads"] += 1
+    return AsyncSessionLocal()
+
+
+@asynccontextmanager
+async def read_session(user_id: Optional[int]) -> AsyncIterator[AsyncSession]:
+    """Like ``get_session`` for read-only routes; see ``read_session_for``."""
+    async with read_session_for(user_id) as session:
+        try:
+            yield session
+        except DBAPIError as e:
+            if session.bind is read_engine and e.connection_invalidated:
+                # الاتصال بالـ replica انقطع: الطلبات الجاية تروح للـ primary فورًا
+                _mark_replica_down(e)
+            raise
+        finally:
+            await session.close()
+
+
+def read_routing_stats() -> dict:
+    return {
+        "enabled": read_engine is not None,
+        "replica_healthy": _replica_result is not None and _replica_result["status"] == "ok",
+        "recent_writers": len(_recent_writers),
+        **_read_stats,
+    }
+
+
+# ---------------- Health ----------------
+# /health/db ينسأل كثير (Render، المراقبة...). بدل SELECT 1 مع كل طلب نحفظ
+# نتيجة آخر فحص DB_HEALTH_CACHE_SECONDS، والطلبات المتزامنة تنتظر نفس الفحص.
+
+DB_HEALTH_CACHE_SECONDS = float(os.getenv("DB_HEALTH_CACHE_SECONDS", "5"))
+
+_health_result: Optional[dict] = None
+_health_checked_at = 0.0
+_health_lock: Optional[asyncio.Lock] = None
+
+
+def pool_status() -> dict:
+    pool = engine.sync_engine.pool
+    stats = {"class": type(pool).__name__}
+    for name in ("size", "checkedin", "checkedout", "overflow"):
+        fn = getattr(pool, name, None)
+        if callable(fn):
+            stats[name] = fn()
+    return stats
+
+
+async def _probe() -> dict:
+    start = time.perf_counter()
+    try:
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+    except Exception as e:
+        return {"status": "error", "detail": str(e)}
+    return {"status": "ok", "latency_ms": round((time.perf_counter() - start) * 1000, 2)}
+
+
+async def check_database() -> dict:
+    """Cached ``SELECT 1`` probe plus live pool statistics."""
+    global _health_result, _health_checked_at, _health_lock
+    if _health_lock is None:
+        _health_lock = asyncio.Lock()
+
+    async with _health_lock:
+        age = time.monotonic() - _health_checked_at
+        if _health_result is None or age >= DB_HEALTH_CACHE_SECONDS:
+            _health_result = await _probe()
+            _health_checked_at = time.monotonic()
+            age = 0.0
+
+    health = {
+        **_health_result,
+        "checked_seconds_ago": round(age, 3),
+        "pool": pool_status(),
+    }
+    if read_engine is not None:
+        # الـ replica ما تأثر على status: لو واقفة القراءة ترجع للـ primary.
+        # نرجع آخر حالة معروفة والفحص (لو قديمة) بالخلفية، مثل توجيه القراءة
+        _replica_usable()
+        replica = dict(_replica_result or {"status": "unknown"})
+        if _replica_result is not None:
+            replica["checked_seconds_ago"] = round(time.monotonic() - _replica_checked_at, 3)
+        health["replica"] = {**replica, **read_routing_stats()}
+    return health
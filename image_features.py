@@ -0,0 +1,52 @@
+# image_features.py
+#
+# حساب خصائص الصورة (الإضاءة، متوسط الألوان...) باستخدام NumPy على مصفوفة واحدة
+# من الصورة بدل بناء قوائم Python لكل بكسل.
+# النتائج مطابقة لطريقة statistics.mean القديمة (نفس المتوسطات بالضبط للقنوات،
+# وفرق أقل من 1e-12 في الإضاءة بسبب تقريب float).
+
+from typing import Dict, Tuple
+
+import numpy as np
+from PIL import Image
+
+
+def image_array(img: Image.Image) -> np.ndarray:
+    """(height, width, 3) uint8 view of an RGB image."""
+    return np.asarray(img)
+
+
+def _mean(total: int, count: int) -> float:
+    # قسمة أعداد صحيحة في Python تعطي float مقرّب بشكل صحيح،
+    # نفس سلوك statistics.mean على الأعداد الصحيحة
+    return total / count
+
+
+def upper_half_luminance(arr: np.ndarray) -> float:
+    """Mean of (R + G + B) / 3 over the top half of the image (rows 0 .. h // 2)."""
+    upper = arr[: arr.shape[0] // 2]
+    pixel_count = upper.shape[0] * upper.shape[1]
+    total = int(upper.sum(dtype=np.uint64))
+    return _mean(total, 3 * pixel_count)
+
+
+def channel_means(arr: np.ndarray) -> Tuple[float, float, float]:
+    pixel_count = arr.shape[0] * arr.shape[1]
+    totals = arr.reshape(-1, 3).sum(axis=0, dtype=np.uint64)
+    return (
+        _mean(int(totals[0]), pixel_count),
+        _mean(int(totals[1]), pixel_count),
+        _mean(int(totals[2]), pixel_count),
+    )
+
+
+def food_color_features(arr: np.ndarray) -> Dict[str, float]:
+    avg_r, avg_g, avg_b = channel_means(arr)
+    return {
+        "avg_r": avg_r,
+        "avg_g": avg_g,
+        "avg_b": avg_b,
+        "brightness": (avg_r + avg_g + avg_b) / 3,
+        "yellow_level": ((avg_r + avg_g) / 2) - avg_b,
+        "green_level": avg_g - max(avg_r, avg_b),
+    }
@@ -0,0 +1,201 @@
+# ingest.py
+#
+# استقبال الصور المرفوعة: قراءة الملف على دفعات مع حد أقصى للحجم، حساب الـ hash
+# أثناء القراءة، وفحص أبعاد الصورة من الهيدر قبل فك الترميز الكامل.
+# الملف نفسه (SpooledTemporaryFile من Starlette) يتسلم لـ PIL بدون نسخ إضافية.
+
+import asyncio
+import hashlib
+import io
+import os
+from dataclasses import dataclass, replace
+from typing import BinaryIO
+
+from fastapi import UploadFile, status
+from fastapi.responses import JSONResponse
+from PIL import Image
+
+from analysis import ImageSource
+from analysis_pool import ANALYSIS_POOL_KIND
+
+
+# أقصى حجم لصورة واحدة (بايت)
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(15 * 1024 * 1024)))
+# أقصى عدد بكسلات (العرض × الارتفاع) قبل ما نرفض الصورة
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", str(40_000_000)))
+# أقصى حجم لطلب /analysis كامل حسب Content-Length (يشمل batch)
+MAX_REQUEST_BYTES = int(os.getenv("MAX_REQUEST_BYTES", str(64 * 1024 * 1024)))
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class UploadRejected(Exception):
+    def __init__(self, status_code: int, message: str) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+
+@dataclass
+class IngestedImage:
+    file: BinaryIO
+    size: int
+    digest: str
+    width: int
+    height: int
+
+    def source(self) -> ImageSource:
+        """What to hand to the analysis pool.
+
+        Threads share memory, so they get the spooled file itself. A process
+        pool can't receive a file object, so it gets the bytes (one copy).
+        """
+        self.file.seek(0)
+        if ANALYSIS_POOL_KIND == "thread":
+            return self.file
+        return self.file.read()
+
+    def detached(self) -> "IngestedImage":
+        """Copy of the upload that outlives the request.
+
+        Starlette closes the spooled file once the response is sent, so
+        background jobs need their own in-memory copy.
+        """
+        self.file.seek(0)
+        return replace(self, file=io.BytesIO(self.file.read()))
+
+
+def _resolution_too_large() -> UploadRejected:
+    return UploadRejected(
+        status.HTTP_413_CONTENT_TOO_LARGE,
+        f"Image resolution is too large (max {MAX_IMAGE_PIXELS // 1_000_000} MP).",
+    )
+
+
+def _ingest_file(file: BinaryIO) -> IngestedImage:
+    file.seek(0)
+    hasher = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = file.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > MAX_UPLOAD_BYTES:
+            raise UploadRejected(
+                status.HTTP_413_CONTENT_TOO_LARGE,
+                f"Image is too large (max {MAX_UPLOAD_BYTES // (1024 * 1024)} MB).",
+            )
+        hasher.update(chunk)
+
+    if size == 0:
+        raise UploadRejected(status.HTTP_400_BAD_REQUEST, "Empty image file.")
+
+    # Image.open يقرأ الهيدر فقط، بدون فك ترميز البكسلات
+    file.seek(0)
+    try:
+        with Image.open(file) as probe:
+            width, height = probe.size
+    except Image.DecompressionBombError:
+        # PIL يرفض الأبعاد الضخمة بنفسه قبل ما نوصل للفحص تحت
+        raise _resolution_too_large()
+    except Exception:
+        raise UploadRejected(status.HTTP_400_BAD_REQUEST, "Unsupported or corrupted image.")
+
+    if width * height > MAX_IMAGE_PIXELS:
+        raise _resolution_too_large()
+
+    file.seek(0)
+    return IngestedImage(
+        file=file,
+        size=size,
+        digest=hasher.hexdigest(),
+        width=width,
+        height=height,
+    )
+
+
+async def ingest_upload(upload: UploadFile) -> IngestedImage:
+    # الملف ممكن يكون انتقل للقرص، فالقراءة تتم في thread بدل الـ event loop
+    return await asyncio.to_thread(_ingest_file, upload.file)
+
+
+def upload_rejected_response(exc: UploadRejected) -> JSONResponse:
+    return JSONResponse(
+        {"success": False, "message": exc.message},
+        status_code=exc.status_code,
+    )
+
+
+class _RequestTooLarge(Exception):
+    pass
+
+
+class UploadSizeLimitMiddleware:
+    """Rejects /analysis uploads larger than MAX_REQUEST_BYTES before
+    Starlette spools the multipart body.
+
+    A Content-Length over the limit is refused up front; without one
+    (chunked uploads) the body is counted as it arrives and the request is
+    cut off as soon as the total goes over.
+    """
+
+    def __init__(self, app, path_prefix: str = "/analysis") -> None:
+        self.app = app
+        self.path_prefix = path_prefix
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.path_prefix):
+            await self.app(scope, receive, send)
+            return
+
+        for name, value in scope["headers"]:
+            if name == b"content-length":
+                try:
+                    too_large = int(value) > MAX_REQUEST_BYTES
+                except ValueError:
+                    too_large = False
+                if too_large:
+                    await self._reject(scope, receive, send)
+                    return
+                break
+
+        received = 0
+        too_large = False
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received, too_large
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > MAX_REQUEST_BYTES:
+                    too_large = True
+                    raise _RequestTooLarge()
+            return message
+
+        async def guarded_send(message):
+            nonlocal response_started
+            if too_large and not response_started:
+                # رد الخطأ من التطبيق (FastAPI يحول فشل قراءة الـ form لـ 400) ما نرسله
+                return
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            # _RequestTooLarge، أو أي خطأ سببه قطع الـ body
+            if not too_large:
+                raise
+        if too_large and not response_started:
+            await self._reject(scope, receive, send)
+
+    @staticmethod
+    async def _reject(scope, receive, send) -> None:
+        response = JSONResponse(
+            {"success": False, "message": "Upload is too large."},
+            status_code=status.HTTP_413_CONTENT_TOO_LARGE,
+        )
+        await response(scope, receive, send)
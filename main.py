@@ -1,14 +1,14 @@
 # main.py
 
 from datetime import timedelta
-import io
+import asyncio
+import logging
 import os
-import statistics
-import time
 import smtplib
+import time
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from typing import Optional, List
+from typing import Awaitable, Callable, Optional, List
 
 from fastapi import (
     Depends,
@@ -16,18 +16,29 @@ from fastapi import (
     File,
     Form,
     HTTPException,
+    Query,
+    Request,
+    Response,
     UploadFile,
     status,
 )
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from fastapi.security import OAuth2PasswordRequestForm
-from PIL import Image
-from sqlalchemy import text, select
+from sqlalchemy import insert, select, update
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from db import Base, engine, get_session
-from models import User, BodyAnalysis, FoodAnalysis, Subscription, WorkoutPlan, MealPlan
+from db import (
+    AsyncSessionLocal,
+    check_database,
+    engine,
+    get_session,
+    note_user_write,
+    read_routing_stats,
+)
+from migrations import AUTO_MIGRATE, migrate
+from models import User, BodyAnalysis, FoodAnalysis, WorkoutPlan, MealPlan
 from schemas import (
     UserCreate,
     UserRead,
@@ -42,18 +53,100 @@ from schemas import (
     MealPlanRead,
 )
 
+from analysis import classify_food, combine_body_two, extract_features, score_body
+from admission import (
+    AdmissionRejected,
+    admission_rejected_handler,
+    analysis_admission,
+    analysis_limiter,
+)
+from analysis_jobs import JobQueueFull, job_queue
+from analysis_pool import (
+    ANALYSIS_POOL_SIZE,
+    ANALYSIS_RETRY_AFTER,
+    AnalysisPoolBusy,
+    pool_stats,
+    run_analysis,
+    shutdown_pool,
+)
+from cache import analysis_cache, analysis_cache_key
+from ingest import (
+    IngestedImage,
+    UploadRejected,
+    UploadSizeLimitMiddleware,
+    ingest_upload,
+    upload_rejected_response,
+)
+from pagination import (
+    HISTORY_MAX_PAGE_SIZE,
+    HISTORY_PAGE_SIZE,
+    decode_cursor,
+    encode_cursor,
+    etag_matches,
+    history_etag,
+)
+from metrics import (
+    MetricsMiddleware,
+    instrument_engine,
+    metrics_response,
+    require_metrics_token,
+    stats_metric,
+)
+from profiling import (
+    ProfilingMiddleware,
+    collapsed_response,
+    find_profile,
+    profiles,
+    profiling_enabled,
+    require_profile_token,
+)
+from subscriptions import (
+    entitlement_stats,
+    get_entitlement,
+    record_subscription,
+    start_subscription_compaction,
+    stop_subscription_compaction,
+)
+from timing import StageTimer
+from write_behind import analysis_writer, write_behind_enabled
 from auth_utils import (
+    UNUSABLE_PASSWORD,
+    Principal,
+    auth_cache_stats,
     create_access_token,
+    create_user_if_absent,
+    get_current_principal,
     get_current_user,
-    get_optional_user,
-    get_password_hash,
-    verify_password,
+    get_current_user_readonly,
+    get_optional_principal,
+    get_or_create_user_id,
+    get_password_hash_async,
+    get_read_session,
+    shutdown_hash_pool,
+    verify_and_update_password,
     get_user_by_email,
+    invalidate_cached_user,
+    revoke_user_tokens,
+    start_revocation_refresh,
+    stop_revocation_refresh,
+    token_cache,
+    user_cache,
 )
 
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
+
 app = FastAPI(title="BodyTalk AI Server")
 
 
+# ---------------- Middleware ----------------
+# آخر middleware يُضاف هو الخارجي:
+# metrics -> profiling -> CORS -> حد حجم الرفع -> التطبيق
+# (metrics برا الكل حتى يحسب زمن الطلبات المرفوضة بـ 413/503 كمان)
+# admission control على مسارات التحليل نفسها: analysis_admission
+
+app.add_middleware(UploadSizeLimitMiddleware)
+app.add_exception_handler(AdmissionRejected, admission_rejected_handler)
+
 # ---------------- CORS ----------------
 app.add_middleware(
     CORSMiddleware,
@@ -61,37 +154,230 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # headers الـ pagination/sync لازم تنكشف حتى يقرأها تطبيق الويب
+    expose_headers=["ETag", "X-Next-Cursor", "X-Sync-Cursor"],
+)
+
+# profiling عند الطلب (مطفي ما لم يُضبط PROFILE_TOKEN أو PROFILE_SAMPLE_RATE)
+if profiling_enabled():
+    app.add_middleware(ProfilingMiddleware)
+
+app.add_middleware(MetricsMiddleware)
+
+
+# ---------------- Metrics ----------------
+
+instrument_engine(engine)
+stats_metric(
+    "bodytalk_analysis_cache",
+    "Analysis result cache counters (hits, misses, evictions, entries...).",
+    analysis_cache.stats,
+)
+stats_metric(
+    "bodytalk_analysis_admission",
+    "Admission control state for the analysis routes.",
+    analysis_limiter.stats,
+)
+stats_metric("bodytalk_analysis_pool", "Analysis worker pool state.", pool_stats)
+stats_metric("bodytalk_analysis_jobs", "Background analysis job queue state.", job_queue.stats)
+stats_metric("bodytalk_analysis_write_behind", "Write-behind buffer for analysis rows.", analysis_writer.stats)
+stats_metric(
+    "bodytalk_subscription_entitlements",
+    "Entitlement cache counters and subscription compaction totals.",
+    entitlement_stats,
+)
+stats_metric("bodytalk_db_read_routing", "Read replica routing counters.", read_routing_stats)
+stats_metric("bodytalk_auth_token_cache", "Decoded JWT cache counters.", token_cache.stats)
+stats_metric(
+    "bodytalk_auth_user_cache",
+    "Authenticated user cache counters (each hit is a users query saved).",
+    user_cache.stats,
+)
+
+
+# /metrics وروابط الـ stats محمية بـ METRICS_TOKEN (Authorization: Bearer)
+@app.get("/metrics", dependencies=[Depends(require_metrics_token)], include_in_schema=False)
+async def metrics():
+    return metrics_response()
+
+
+# ---------------- Profiling ----------------
+# كلها محمية بنفس الـ header: X-Profile-Token
+
+@app.get("/admin/profiles", dependencies=[Depends(require_profile_token)], include_in_schema=False)
+async def list_profiles():
+    return [profile.summary() for profile in reversed(profiles)]
+
+
+@app.get("/admin/profiles/{profile_id}", dependencies=[Depends(require_profile_token)], include_in_schema=False)
+async def get_profile(profile_id: str):
+    return find_profile(profile_id).summary(top=25)
+
+
+@app.get(
+    "/admin/profiles/{profile_id}/collapsed",
+    dependencies=[Depends(require_profile_token)],
+    include_in_schema=False,
 )
+async def download_profile(profile_id: str):
+    """Collapsed stacks, one per line, for flamegraph.pl or speedscope."""
+    return collapsed_response(find_profile(profile_id))
 
 
 # ------------- Database Setup --------------
 
 @app.on_event("startup")
 async def on_startup() -> None:
-    """Create tables if they don't exist."""
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    """Apply migrations (when AUTO_MIGRATE), load token revocations and start the background tasks."""
+    if AUTO_MIGRATE:
+        await migrate(engine)
+    await start_revocation_refresh()
+    await start_subscription_compaction()
+    if write_behind_enabled():
+        await analysis_writer.start()
+    await job_queue.start()
+
+
+@app.on_event("shutdown")
+async def on_shutdown() -> None:
+    await job_queue.stop()
+    # بعد الـ jobs لأنها ممكن تضيف صفوف؛ اللي ما ينكتب ينحفظ في ملف الـ spill
+    if write_behind_enabled():
+        await analysis_writer.stop()
+    await stop_revocation_refresh()
+    await stop_subscription_compaction()
+    shutdown_pool()
+    shutdown_hash_pool()
+    analysis_cache.close()
 
 
 @app.get("/health/db")
-async def health_db(session: AsyncSession = Depends(get_session)):
+async def health_db():
+    health = await check_database()
+    if health["status"] != "ok":
+        return JSONResponse(health, status_code=500)
+    return health
+
+
+# ------------- Analysis Helpers --------------
+
+def _normalize_language(language: Optional[str]) -> str:
+    lang = (language or "en").lower().strip()
+    if lang not in ["en", "fr", "ar"]:
+        lang = "en"
+    return lang
+
+
+def _pool_busy_response() -> JSONResponse:
+    return JSONResponse(
+        {"success": False, "message": "Server is busy, please try again shortly."},
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        headers={"Retry-After": str(ANALYSIS_RETRY_AFTER)},
+    )
+
+
+async def _extract(kind: str, image: IngestedImage, timer: StageTimer, prefix: str = ""):
+    """Decode one upload and extract its features on the pool.
+
+    ``pool_wait`` is the time spent waiting for a free worker.
+    """
+    start = time.perf_counter()
+    features, timings = await run_analysis(extract_features, kind, image.source())
+    timings["pool_wait"] = max(0.0, time.perf_counter() - start - sum(timings.values()))
+    timer.record(timings, prefix)
+    return features
+
+
+async def _run_cached_analysis(
+    cache_key: str,
+    kind: str,
+    image: IngestedImage,
+    timer: StageTimer,
+    classify: Callable,
+) -> dict:
+    """Return the cached result for this upload, or compute it on the pool."""
+    result = await analysis_cache.aget(cache_key)
+    if result is None:
+        features = await _extract(kind, image, timer)
+        with timer.stage("classify"):
+            result = classify(features)
+        analysis_cache.set(cache_key, result)
+    return result
+
+
+async def _save_analyses(session: AsyncSession, timer: StageTimer, *rows) -> None:
+    """Persist analysis rows: commit now, or hand them to the write-behind buffer."""
+    if write_behind_enabled():
+        with timer.stage("db_enqueue"):
+            analysis_writer.add(*rows)
+    else:
+        with timer.stage("db_write"):
+            session.add_all(rows)
+            await session.commit()
+    for user_id in {row.user_id for row in rows}:
+        note_user_write(user_id)
+
+
+def _enqueue_analysis_job(
+    kind: str,
+    user_id: Optional[int],
+    analyze: Callable[[AsyncSession], Awaitable[dict]],
+) -> JSONResponse:
+    """Queue an analysis for background execution and answer 202 right away."""
+
+    async def run() -> dict:
+        # جلسة الطلب تنغلق مع الرد، فالـ job يفتح جلسة خاصة فيه
+        async with AsyncSessionLocal() as job_session:
+            return await analyze(job_session)
+
     try:
-        await session.execute(text("SELECT 1"))
-        return {"status": "ok"}
-    except Exception as e:
+        job = job_queue.submit(kind, user_id, run)
+    except JobQueueFull:
         return JSONResponse(
-            {"status": "error", "detail": str(e)},
-            status_code=500,
+            {"success": False, "message": "Too many pending analyses, please try again shortly."},
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            headers={"Retry-After": str(ANALYSIS_RETRY_AFTER)},
         )
 
+    return JSONResponse(
+        {
+            "success": True,
+            "job_id": job.id,
+            "status": job.status,
+            "status_url": f"/analysis/jobs/{job.id}",
+        },
+        status_code=status.HTTP_202_ACCEPTED,
+    )
+
+
+@app.get("/analysis/cache/stats", dependencies=[Depends(require_metrics_token)])
+async def analysis_cache_stats():
+    return analysis_cache.stats()
+
+
+@app.get("/auth/cache/stats", dependencies=[Depends(require_metrics_token)])
+async def auth_cache_stats_route():
+    return auth_cache_stats()
 
-# ------------- Image Helper --------------
 
-def _open_image(upload_file: UploadFile) -> Image.Image:
-    content = upload_file.file.read()
-    img = Image.open(io.BytesIO(content)).convert("RGB")
-    img.thumbnail((256, 256))
-    return img
+@app.get("/analysis/admission/stats", dependencies=[Depends(require_metrics_token)])
+async def analysis_admission_stats():
+    return analysis_limiter.stats()
+
+
+@app.get("/analysis/jobs/{job_id}")
+async def get_analysis_job(
+    job_id: str,
+    principal: Optional[Principal] = Depends(get_optional_principal),
+):
+    job = job_queue.get(job_id)
+    # jobs المستخدمين المسجلين ما يشوفها إلا صاحبها
+    if job is None or (
+        job.user_id is not None
+        and (principal is None or principal.user_id != job.user_id)
+    ):
+        raise HTTPException(status_code=404, detail="Analysis job not found or expired.")
+    return job.to_dict()
 
 
 # ------------- Auth / User Registration --------------
@@ -99,32 +385,29 @@ def _open_image(upload_file: UploadFile) -> Image.Image:
 
 @app.post("/auth/register", response_model=UserRead)
 async def register_user(payload: UserCreate, session: AsyncSession = Depends(get_session)):
-    # Is email already in use?
-    existing = await get_user_by_email(payload.email, session)
-    if existing:
+    hashed_password = await get_password_hash_async(payload.password)
+
+    # Insert unless the email is already in use (one statement, race-free)
+    user = await create_user_if_absent(
+        {
+            "email": payload.email,
+            "hashed_password": hashed_password,
+            "full_name": payload.full_name,
+            "gender": payload.gender,
+            "age": payload.age,
+            "height_cm": payload.height_cm,
+            "weight_kg": payload.weight_kg,
+            "activity_level": payload.activity_level,
+            "goal": payload.goal,
+        },
+        session,
+    )
+    if user is None:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="This email is already in use.",
         )
 
-    hashed_password = get_password_hash(payload.password)
-
-    user = User(
-        email=payload.email,
-        hashed_password=hashed_password,
-        full_name=payload.full_name,
-        gender=payload.gender,
-        age=payload.age,
-        height_cm=payload.height_cm,
-        weight_kg=payload.weight_kg,
-        activity_level=payload.activity_level,
-        goal=payload.goal,
-    )
-
-    session.add(user)
-    await session.commit()
-    await session.refresh(user)
-
     return user
 
 
@@ -135,12 +418,23 @@ async def login_for_access_token(
 ):
     # We use username as email
     user = await get_user_by_email(form_data.username, session)
-    if not user or not verify_password(form_data.password, user.hashed_password):
+    verified, new_hash = (False, None)
+    if user:
+        verified, new_hash = await verify_and_update_password(
+            form_data.password, user.hashed_password
+        )
+    if not verified:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Incorrect login credentials.",
         )
 
+    # الـ hash المخزن بتكلفة غير BCRYPT_ROUNDS -> نحدثه الآن وكلمة المرور معنا
+    if new_hash is not None:
+        user.hashed_password = new_hash
+        await session.commit()
+        invalidate_cached_user(user.id)
+
     access_token_expires = timedelta(minutes=60 * 24 * 7)
     access_token = create_access_token(
         data={"sub": str(user.id)},
@@ -170,37 +464,21 @@ async def social_login(
             detail="Email is required for social login.",
         )
 
-    # Check if user exists
-    user = await get_user_by_email(email, session)
-
-    if not user:
-        # Create new user with social login
-        # Generate a random secure password (user won't need it for social login)
-        import secrets
-        random_password = secrets.token_urlsafe(32)
-        hashed_password = get_password_hash(random_password)
-
-        user = User(
-            email=email,
-            hashed_password=hashed_password,
-            full_name=name or email.split('@')[0],
-            # Set defaults for required fields
-            gender=None,
-            age=None,
-            height_cm=None,
-            weight_kg=None,
-            activity_level=None,
-            goal=None,
-        )
-
-        session.add(user)
-        await session.commit()
-        await session.refresh(user)
+    # Create the user if it doesn't exist, or fetch the existing id (no write for existing users).
+    # Social accounts get an unusable password: nothing to hash, and password login never matches.
+    user_id = await get_or_create_user_id(
+        {
+            "email": email,
+            "hashed_password": UNUSABLE_PASSWORD,
+            "full_name": name or email.split('@')[0],
+        },
+        session,
+    )
 
     # Generate access token
     access_token_expires = timedelta(minutes=60 * 24 * 7)
     access_token = create_access_token(
-        data={"sub": str(user.id)},
+        data={"sub": str(user_id)},
         expires_delta=access_token_expires,
     )
 
@@ -208,10 +486,20 @@ async def social_login(
 
 
 @app.get("/auth/me", response_model=UserRead)
-async def read_current_user_auth(current_user: User = Depends(get_current_user)):
+async def read_current_user_auth(current_user: User = Depends(get_current_user_readonly)):
     return current_user
 
 
+@app.post("/auth/logout-all")
+async def logout_all_devices(
+    session: AsyncSession = Depends(get_session),
+    principal: Principal = Depends(get_current_principal),
+):
+    """Revoke every token issued to the caller so far (all devices)."""
+    await revoke_user_tokens(principal.user_id, session)
+    return {"success": True}
+
+
 @app.post("/auth/forgot-password")
 async def forgot_password(
     payload: dict,
@@ -331,7 +619,7 @@ async def list_all_users(session: AsyncSession = Depends(get_session)):
 
 
 @app.get("/users/me", response_model=UserRead)
-async def get_me(current_user: User = Depends(get_current_user)):
+async def get_me(current_user: User = Depends(get_current_user_readonly)):
     return current_user
 
 
@@ -348,6 +636,8 @@ async def update_me(
 
     session.add(current_user)
     await session.commit()
+    invalidate_cached_user(current_user.id)
+    note_user_write(current_user.id)
     await session.refresh(current_user)
 
     return current_user
@@ -408,97 +698,104 @@ BODY_ADVICE_TRANSLATIONS = {
 }
 
 
-@app.post("/analysis/body-two")
+async def _analyze_body_two(
+    front_image: IngestedImage,
+    side_image: IngestedImage,
+    lang: str,
+    user_id: Optional[int],
+    session: AsyncSession,
+    timer: StageTimer,
+) -> dict:
+    cache_key = analysis_cache_key(
+        "body-two",
+        [front_image.digest, side_image.digest],
+        lang,
+    )
+    result = await analysis_cache.aget(cache_key)
+    if result is None:
+        # الصورتين تُفك ترميزهما بالتوازي على الـ pool
+        front_features, side_features = await asyncio.gather(
+            _extract("body", front_image, timer, "front_"),
+            _extract("body", side_image, timer, "side_"),
+        )
+        with timer.stage("combine"):
+            result = combine_body_two(front_features, side_features)
+        analysis_cache.set(cache_key, result)
+
+    fat_percent = result["body_fat"]
+    muscle_percent = result["muscle_mass"]
+    bmi = result["bmi"]
+    aspect_ratio = result["aspect_ratio"]
+
+    body_shape = BODY_SHAPE_TRANSLATIONS[result["shape_key"]][lang]
+    advice = BODY_ADVICE_TRANSLATIONS[result["advice_key"]][lang]
+
+    saved = False
+    if user_id is not None:
+        analysis = BodyAnalysis(
+            user_id=user_id,
+            shape=body_shape,
+            body_fat=round(fat_percent, 1),
+            muscle_mass=round(muscle_percent, 1),
+            bmi=round(bmi, 1),
+            aspect_ratio=aspect_ratio,
+        )
+        await _save_analyses(session, timer, analysis)
+        saved = True
+
+    timer.finish()
+
+    return {
+        "success": True,
+        "shape": body_shape,
+        "body_fat": round(fat_percent, 1),
+        "muscle_mass": round(muscle_percent, 1),
+        "bmi": round(bmi, 1),
+        "aspect_ratio": round(aspect_ratio, 3),
+        "advice": advice,
+        "saved": saved,
+        "analysis_type": "two_photos",
+    }
+
+
+@app.post("/analysis/body-two", dependencies=[Depends(analysis_admission)])
 async def analyze_body_two_images(
     front_file: UploadFile = File(...),
     side_file: UploadFile = File(...),
     language: Optional[str] = Form(default="en"),
+    async_mode: bool = Query(default=False, alias="async"),
     session: AsyncSession = Depends(get_session),
-    current_user: Optional[User] = Depends(get_optional_user),
+    principal: Optional[Principal] = Depends(get_optional_principal),
 ):
     """Analyze body using both front and side photos for better accuracy"""
     try:
-        time.sleep(1.5)
-        
-        lang = (language or "en").lower().strip()
-        if lang not in ["en", "fr", "ar"]:
-            lang = "en"
-
-        # Process front image
-        front_img = _open_image(front_file)
-        w_f, h_f = front_img.size
-        aspect_front = round(h_f / w_f, 3) if w_f > 0 else 1.0
-
-        upper_f = front_img.crop((0, 0, w_f, h_f // 2))
-        pixels_f = list(upper_f.getdata())
-        luminances_f = [sum(p) / 3 for p in pixels_f]
-        avg_lum_f = statistics.mean(luminances_f)
-
-        # Process side image
-        side_img = _open_image(side_file)
-        w_s, h_s = side_img.size
-        aspect_side = round(h_s / w_s, 3) if w_s > 0 else 1.0
-
-        upper_s = side_img.crop((0, 0, w_s, h_s // 2))
-        pixels_s = list(upper_s.getdata())
-        luminances_s = [sum(p) / 3 for p in pixels_s]
-        avg_lum_s = statistics.mean(luminances_s)
-
-        # Combined analysis (average of both images)
-        avg_lum = (avg_lum_f + avg_lum_s) / 2
-        relative_lum = max(0.0, min(1.0, (avg_lum - 80) / (210 - 80)))
-
-        # More accurate with 2 photos - slightly adjusted ranges
-        fat_percent = 10 + relative_lum * 18
-        muscle_percent = 32 + (1 - relative_lum) * 22
-        bmi = 19 + (fat_percent - 10) * (12 / 18)
-        aspect_ratio = (aspect_front + aspect_side) / 2
-
-        if fat_percent <= 12.5:
-            shape_key = "very_athletic"
-            advice_key = "athletic"
-        elif fat_percent <= 16:
-            shape_key = "athletic"
-            advice_key = "athletic"
-        elif fat_percent <= 21:
-            shape_key = "balanced"
-            advice_key = "balanced"
-        elif fat_percent <= 25:
-            shape_key = "full"
-            advice_key = "full"
-        else:
-            shape_key = "high_fat"
-            advice_key = "high_fat"
-        
-        body_shape = BODY_SHAPE_TRANSLATIONS[shape_key][lang]
-        advice = BODY_ADVICE_TRANSLATIONS[advice_key][lang]
-
-        saved = False
-        if current_user is not None:
-            analysis = BodyAnalysis(
-                user_id=current_user.id,
-                shape=body_shape,
-                body_fat=round(fat_percent, 1),
-                muscle_mass=round(muscle_percent, 1),
-                bmi=round(bmi, 1),
-                aspect_ratio=aspect_ratio,
+        lang = _normalize_language(language)
+        user_id = principal.user_id if principal is not None else None
+
+        timer = StageTimer("body-two")
+        with timer.stage("ingest"):
+            front_image, side_image = await asyncio.gather(
+                ingest_upload(front_file),
+                ingest_upload(side_file),
             )
-            session.add(analysis)
-            await session.commit()
-            saved = True
 
-        return {
-            "success": True,
-            "shape": body_shape,
-            "body_fat": round(fat_percent, 1),
-            "muscle_mass": round(muscle_percent, 1),
-            "bmi": round(bmi, 1),
-            "aspect_ratio": round(aspect_ratio, 3),
-            "advice": advice,
-            "saved": saved,
-            "analysis_type": "two_photos",
-        }
+        if async_mode:
+            front_image = front_image.detached()
+            side_image = side_image.detached()
+            return _enqueue_analysis_job(
+                "body-two",
+                user_id,
+                lambda job_session: _analyze_body_two(
+                    front_image, side_image, lang, user_id, job_session, timer
+                ),
+            )
+
+        return await _analyze_body_two(front_image, side_image, lang, user_id, session, timer)
 
+    except UploadRejected as e:
+        return upload_rejected_response(e)
+    except AnalysisPoolBusy:
+        return _pool_busy_response()
     except Exception as e:
         return JSONResponse(
             {"success": False, "message": f"Error analyzing body: {e}"},
@@ -506,81 +803,82 @@ async def analyze_body_two_images(
         )
 
 
-@app.post("/analysis/body")
+async def _analyze_body(
+    image: IngestedImage,
+    lang: str,
+    user_id: Optional[int],
+    session: AsyncSession,
+    timer: StageTimer,
+) -> dict:
+    cache_key = analysis_cache_key("body", [image.digest], lang)
+    result = await _run_cached_analysis(
+        cache_key, "body", image, timer, lambda features: score_body(*features)
+    )
+
+    fat_percent = result["body_fat"]
+    muscle_percent = result["muscle_mass"]
+    bmi = result["bmi"]
+    aspect_ratio = result["aspect_ratio"]
+
+    body_shape = BODY_SHAPE_TRANSLATIONS[result["shape_key"]][lang]
+    advice = BODY_ADVICE_TRANSLATIONS[result["advice_key"]][lang]
+
+    saved = False
+    if user_id is not None:
+        analysis = BodyAnalysis(
+            user_id=user_id,
+            shape=body_shape,
+            body_fat=round(fat_percent, 1),
+            muscle_mass=round(muscle_percent, 1),
+            bmi=round(bmi, 1),
+            aspect_ratio=aspect_ratio,
+        )
+        await _save_analyses(session, timer, analysis)
+        saved = True
+
+    timer.finish()
+
+    return {
+        "success": True,
+        "shape": body_shape,
+        "body_fat": round(fat_percent, 1),
+        "muscle_mass": round(muscle_percent, 1),
+        "bmi": round(bmi, 1),
+        "aspect_ratio": aspect_ratio,
+        "advice": advice,
+        "saved": saved,
+    }
+
+
+@app.post("/analysis/body", dependencies=[Depends(analysis_admission)])
 async def analyze_body_image(
     file: UploadFile = File(...),
     language: Optional[str] = Form(default="en"),
+    async_mode: bool = Query(default=False, alias="async"),
     session: AsyncSession = Depends(get_session),
-    current_user: Optional[User] = Depends(get_optional_user),
+    principal: Optional[Principal] = Depends(get_optional_principal),
 ):
     try:
-        time.sleep(1.2)
-        
-        # Normalize language code
-        lang = (language or "en").lower().strip()
-        if lang not in ["en", "fr", "ar"]:
-            lang = "en"
-
-        img = _open_image(file)
-        w, h = img.size
-        aspect_ratio = round(h / w, 3) if w > 0 else 1.0
-
-        upper = img.crop((0, 0, w, h // 2))
-        pixels = list(upper.getdata())
-        luminances = [sum(p) / 3 for p in pixels]
-        avg_lum = statistics.mean(luminances)
-
-        relative_lum = max(0.0, min(1.0, (avg_lum - 80) / (210 - 80)))
-
-        fat_percent = 12 + relative_lum * 16
-        muscle_percent = 30 + (1 - relative_lum) * 20
-        bmi = 20 + (fat_percent - 12) * (10 / 16)
-
-        # Determine shape key and get localized values
-        if fat_percent <= 13.5:
-            shape_key = "very_athletic"
-            advice_key = "athletic"
-        elif fat_percent <= 17:
-            shape_key = "athletic"
-            advice_key = "athletic"
-        elif fat_percent <= 22:
-            shape_key = "balanced"
-            advice_key = "balanced"
-        elif fat_percent <= 26:
-            shape_key = "full"
-            advice_key = "full"
-        else:
-            shape_key = "high_fat"
-            advice_key = "high_fat"
-        
-        body_shape = BODY_SHAPE_TRANSLATIONS[shape_key][lang]
-        advice = BODY_ADVICE_TRANSLATIONS[advice_key][lang]
-
-        saved = False
-        if current_user is not None:
-            analysis = BodyAnalysis(
-                user_id=current_user.id,
-                shape=body_shape,
-                body_fat=round(fat_percent, 1),
-                muscle_mass=round(muscle_percent, 1),
-                bmi=round(bmi, 1),
-                aspect_ratio=aspect_ratio,
+        lang = _normalize_language(language)
+        user_id = principal.user_id if principal is not None else None
+
+        timer = StageTimer("body")
+        image = await timer.timed("ingest", ingest_upload(file))
+
+        if async_mode:
+            image = image.detached()
+            return _enqueue_analysis_job(
+                "body",
+                user_id,
+                lambda job_session: _analyze_body(image, lang, user_id, job_session, timer),
             )
-            session.add(analysis)
-            await session.commit()
-            saved = True
 
-        return {
-            "success": True,
-            "shape": body_shape,
-            "body_fat": round(fat_percent, 1),
-            "muscle_mass": round(muscle_percent, 1),
-            "bmi": round(bmi, 1),
-            "aspect_ratio": aspect_ratio,
-            "advice": advice,
-            "saved": saved,
-        }
+        return await _analyze_body(image, lang, user_id, session, timer)
 
+    except UploadRejected as e:
+        return upload_rejected_response(e)
+    except AnalysisPoolBusy:
+        return _pool_busy_response()
     except Exception as e:
         return JSONResponse(
             {"success": False, "message": f"Error analyzing body: {e}"},
@@ -628,91 +926,83 @@ MEAL_ADVICE_TRANSLATIONS = {
 }
 
 
-@app.post("/analysis/food")
+async def _analyze_food(
+    image: IngestedImage,
+    lang: str,
+    cuisine: Optional[str],
+    user_id: Optional[int],
+    session: AsyncSession,
+    timer: StageTimer,
+) -> dict:
+    cache_key = analysis_cache_key("food", [image.digest], lang, cuisine)
+    result = await _run_cached_analysis(cache_key, "food", image, timer, classify_food)
+
+    meal_key = result["meal_key"]
+    calories = result["calories"]
+    protein = result["protein"]
+    carbs = result["carbs"]
+    fats = result["fats"]
+
+    meal_name = MEAL_TRANSLATIONS[meal_key][lang]
+    advice = MEAL_ADVICE_TRANSLATIONS[meal_key][lang]
+
+    saved = False
+    if user_id is not None:
+        analysis = FoodAnalysis(
+            user_id=user_id,
+            meal_name=meal_name,
+            calories=calories,
+            protein=protein,
+            carbs=carbs,
+            fats=fats,
+        )
+        await _save_analyses(session, timer, analysis)
+        saved = True
+
+    timer.finish()
+
+    return {
+        "success": True,
+        "meal_name": meal_name,
+        "calories": calories,
+        "protein": protein,
+        "carbs": carbs,
+        "fats": fats,
+        "advice": advice,
+        "saved": saved,
+    }
+
+
+@app.post("/analysis/food", dependencies=[Depends(analysis_admission)])
 async def analyze_food_image(
     file: UploadFile = File(...),
     language: Optional[str] = Form(default="en"),
     cuisine: Optional[str] = Form(default="general"),
+    async_mode: bool = Query(default=False, alias="async"),
     session: AsyncSession = Depends(get_session),
-    current_user: Optional[User] = Depends(get_optional_user),
+    principal: Optional[Principal] = Depends(get_optional_principal),
 ):
     try:
-        time.sleep(1.4)
-        
-        # Normalize language code
-        lang = (language or "en").lower().strip()
-        if lang not in ["en", "fr", "ar"]:
-            lang = "en"
-
-        img = _open_image(file)
-        pixels = list(img.getdata())
-
-        reds = [p[0] for p in pixels]
-        greens = [p[1] for p in pixels]
-        blues = [p[2] for p in pixels]
-
-        avg_r = statistics.mean(reds)
-        avg_g = statistics.mean(greens)
-        avg_b = statistics.mean(blues)
-        avg_brightness = (avg_r + avg_g + avg_b) / 3
-
-        yellow_level = ((avg_r + avg_g) / 2) - avg_b
-        green_level = avg_g - max(avg_r, avg_b)
-
-        yellow_score = max(0.0, min(1.0, (yellow_level - 0) / 90))
-        green_score = max(0.0, min(1.0, (green_level + 20) / 140))
-        brightness_norm = max(0.0, min(1.0, (avg_brightness - 60) / 210))
-
-        is_high_cal = yellow_score >= 0.3 and brightness_norm > 0.25
-        is_light = green_score >= 0.55 and yellow_score < 0.2
-
-        if is_high_cal and not is_light:
-            meal_key = "high_cal"
-            calories = 800
-            protein = 30
-            carbs = 95
-            fats = 40
-        elif is_light and not is_high_cal:
-            meal_key = "light"
-            calories = 280
-            protein = 10
-            carbs = 30
-            fats = 8
-        else:
-            meal_key = "moderate"
-            calories = 550
-            protein = 25
-            carbs = 60
-            fats = 18
-        
-        meal_name = MEAL_TRANSLATIONS[meal_key][lang]
-        advice = MEAL_ADVICE_TRANSLATIONS[meal_key][lang]
-
-        saved = False
-        if current_user is not None:
-            analysis = FoodAnalysis(
-                user_id=current_user.id,
-                meal_name=meal_name,
-                calories=calories,
-                protein=protein,
-                carbs=carbs,
-                fats=fats,
+        lang = _normalize_language(language)
+        user_id = principal.user_id if principal is not None else None
+
+        timer = StageTimer("food")
+        image = await timer.timed("ingest", ingest_upload(file))
+
+        if async_mode:
+            image = image.detached()
+            return _enqueue_analysis_job(
+                "food",
+                user_id,
+                lambda job_session: _analyze_food(image, lang, cuisine, user_id, job_session, timer),
             )
-            session.add(analysis)
-            await session.commit()
-            saved = True
 
-        return {
-            "success": True,
-            "meal_name": meal_name,
-            "calories": calories,
-            "protein": protein,
-            "carbs": carbs,
-            "fats": fats,
-            "advice": advice,
-            "saved": saved,
-        }
+        return await _analyze_food(image, lang, cuisine, user_id, session, timer)
 
+    except UploadRejected as e:
+        return upload_rejected_response(e)
+    except AnalysisPoolBusy:
+        return _pool_busy_response()
     except Exception as e:
         return JSONResponse(
             {"success": False, "message": f"Error analyzing meal: {e}"},
@@ -720,39 +1010,216 @@ async def analyze_food_image(
         )
 
 
-# ------------- Analysis History -------------
+# أقصى عدد صور في طلب batch واحد
+ANALYSIS_BATCH_MAX_FILES = int(os.getenv("ANALYSIS_BATCH_MAX_FILES", "20"))
 
 
-@app.get("/analysis/body/history", response_model=List[BodyAnalysisItem])
-async def get_body_history(
+@app.post("/analysis/food/batch", dependencies=[Depends(analysis_admission)])
+async def analyze_food_batch(
+    files: List[UploadFile] = File(...),
+    language: Optional[str] = Form(default="en"),
+    cuisine: Optional[str] = Form(default="general"),
     session: AsyncSession = Depends(get_session),
-    current_user: User = Depends(get_current_user),
+    principal: Optional[Principal] = Depends(get_optional_principal),
 ):
-    stmt = (
-        select(BodyAnalysis)
-        .where(BodyAnalysis.user_id == current_user.id)
-        .order_by(BodyAnalysis.created_at.desc())
-        .limit(100)
+    """
+    Analyze several meal photos in one request.
+    Images run concurrently on the analysis pool and all rows are saved
+    with a single commit. Results keep the order of the uploaded files.
+    """
+    if len(files) > ANALYSIS_BATCH_MAX_FILES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {ANALYSIS_BATCH_MAX_FILES} images per batch.",
+        )
+
+    lang = _normalize_language(language)
+
+    # batch واحد ما يحجز أكثر من عدد الـ workers، حتى ما يملأ الطابور لوحده
+    slots = asyncio.Semaphore(ANALYSIS_POOL_SIZE)
+
+    async def analyze_one(upload: UploadFile) -> dict:
+        async with slots:
+            timer = StageTimer("food-batch-item")
+            image = await timer.timed("ingest", ingest_upload(upload))
+            cache_key = analysis_cache_key("food", [image.digest], lang, cuisine)
+            result = await _run_cached_analysis(cache_key, "food", image, timer, classify_food)
+            timer.finish()
+            return result
+
+    outcomes = await asyncio.gather(
+        *(analyze_one(upload) for upload in files),
+        return_exceptions=True,
     )
-    result = await session.execute(stmt)
+
+    items = []
+    rows = []
+    for index, outcome in enumerate(outcomes):
+        if isinstance(outcome, UploadRejected):
+            items.append({"index": index, "success": False, "message": outcome.message})
+            continue
+        if isinstance(outcome, AnalysisPoolBusy):
+            items.append({
+                "index": index,
+                "success": False,
+                "message": "Server is busy, please try again shortly.",
+            })
+            continue
+        if isinstance(outcome, Exception):
+            items.append({
+                "index": index,
+                "success": False,
+                "message": f"Error analyzing meal: {outcome}",
+            })
+            continue
+
+        meal_key = outcome["meal_key"]
+        item = {
+            "index": index,
+            "success": True,
+            "meal_name": MEAL_TRANSLATIONS[meal_key][lang],
+            "calories": outcome["calories"],
+            "protein": outcome["protein"],
+            "carbs": outcome["carbs"],
+            "fats": outcome["fats"],
+            "advice": MEAL_ADVICE_TRANSLATIONS[meal_key][lang],
+            "saved": False,
+        }
+        items.append(item)
+
+        if principal is not None:
+            rows.append(FoodAnalysis(
+                user_id=principal.user_id,
+                meal_name=item["meal_name"],
+                calories=item["calories"],
+                protein=item["protein"],
+                carbs=item["carbs"],
+                fats=item["fats"],
+            ))
+
+    if rows:
+        try:
+            batch_timer = StageTimer("food-batch")
+            await _save_analyses(session, batch_timer, *rows)
+            batch_timer.finish()
+        except Exception as e:
+            await session.rollback()
+            return JSONResponse(
+                {"success": False, "message": f"Error saving meals: {e}"},
+                status_code=500,
+            )
+        for item in items:
+            if item["success"]:
+                item["saved"] = True
+
+    return {
+        "success": all(item["success"] for item in items),
+        "count": len(items),
+        "saved": len(rows),
+        "results": items,
+    }
+
+
+# ------------- Analysis History -------------
+
+
+async def _history_page(
+    model,
+    kind: str,
+    user_id: int,
+    session: AsyncSession,
+    request: Request,
+    response: Response,
+    limit: int,
+    cursor: Optional[str],
+    since: Optional[str],
+):
+    """
+    Newest-first page of one user's history.
+
+    ``cursor`` (from X-Next-Cursor) continues to older rows; ``since``
+    (from X-Sync-Cursor of an earlier response) keeps only rows newer than
+    the client's last sync. Answers 304 when the ETag still matches.
+    """
+    before = decode_cursor(cursor)
+    after = decode_cursor(since, "since")
+    if_none_match = request.headers.get("if-none-match")
+
+    async def latest_row():
+        return await session.scalar(
+            select(model.id)
+            .where(model.user_id == user_id)
+            .order_by(model.id.desc())
+            .limit(1)
+        )
+
+    # مع If-None-Match: استعلام صف واحد، ولو ما تغير شي نرد 304 بدون ما نقرأ الصفحة
+    latest = None
+    if if_none_match:
+        latest = await latest_row()
+        etag = history_etag(kind, latest, limit, cursor, since)
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+    stmt = select(model).where(model.user_id == user_id)
+    if before is not None:
+        stmt = stmt.where(model.id < before)
+    if after is not None:
+        stmt = stmt.where(model.id > after)
+    # صف زيادة حتى نعرف إذا في صفحة بعدها
+    result = await session.execute(stmt.order_by(model.id.desc()).limit(limit + 1))
     items = result.scalars().all()
+
+    has_more = len(items) > limit
+    items = items[:limit]
+
+    if not if_none_match:
+        if before is None and items:
+            # أول صف في الصفحة الأولى هو أحدث صف للمستخدم
+            latest = items[0].id
+        else:
+            latest = await latest_row()
+
+    response.headers["ETag"] = history_etag(kind, latest, limit, cursor, since)
+    response.headers["Cache-Control"] = "private, no-cache"
+    if latest is not None:
+        response.headers["X-Sync-Cursor"] = encode_cursor(latest)
+    if has_more:
+        response.headers["X-Next-Cursor"] = encode_cursor(items[-1].id)
+
     return items
 
 
+@app.get("/analysis/body/history", response_model=List[BodyAnalysisItem])
+async def get_body_history(
+    request: Request,
+    response: Response,
+    limit: int = Query(default=HISTORY_PAGE_SIZE, ge=1, le=HISTORY_MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(default=None),
+    since: Optional[str] = Query(default=None),
+    session: AsyncSession = Depends(get_read_session),
+    principal: Principal = Depends(get_current_principal),
+):
+    return await _history_page(
+        BodyAnalysis, "body", principal.user_id, session,
+        request, response, limit, cursor, since,
+    )
+
+
 @app.get("/analysis/food/history", response_model=List[FoodAnalysisItem])
 async def get_food_history(
-    session: AsyncSession = Depends(get_session),
-    current_user: User = Depends(get_current_user),
+    request: Request,
+    response: Response,
+    limit: int = Query(default=HISTORY_PAGE_SIZE, ge=1, le=HISTORY_MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(default=None),
+    since: Optional[str] = Query(default=None),
+    session: AsyncSession = Depends(get_read_session),
+    principal: Principal = Depends(get_current_principal),
 ):
-    stmt = (
-        select(FoodAnalysis)
-        .where(FoodAnalysis.user_id == current_user.id)
-        .order_by(FoodAnalysis.created_at.desc())
-        .limit(100)
+    return await _history_page(
+        FoodAnalysis, "food", principal.user_id, session,
+        request, response, limit, cursor, since,
     )
-    result = await session.execute(stmt)
-    items = result.scalars().all()
-    return items
 
 
 # ------------- Premium Subscription (Server Only) -------------
@@ -760,94 +1227,89 @@ async def get_food_history(
 
 @app.get("/subscriptions/me", response_model=SubscriptionStatus)
 async def get_my_subscription(
-    session: AsyncSession = Depends(get_session),
-    current_user: User = Depends(get_current_user),
+    session: AsyncSession = Depends(get_read_session),
+    principal: Principal = Depends(get_current_principal),
 ):
-    stmt = (
-        select(Subscription)
-        .where(Subscription.user_id == current_user.id)
-        .order_by(Subscription.created_at.desc())
-        .limit(1)
-    )
-    result = await session.execute(stmt)
-    sub = result.scalar_one_or_none()
-
-    if not sub:
-        return SubscriptionStatus(is_active=False, plan=None, provider=None)
-
-    return SubscriptionStatus(
-        is_active=sub.is_active,
-        plan=sub.plan,
-        provider=sub.provider,
-    )
+    # user_entitlements: صف واحد لكل مستخدم، وغالبًا من الكاش بدون استعلام
+    return SubscriptionStatus(**await get_entitlement(principal.user_id, session))
 
 
 @app.post("/subscriptions/activate-test", response_model=SubscriptionStatus)
 async def activate_test_subscription(
     session: AsyncSession = Depends(get_session),
-    current_user: User = Depends(get_current_user),
+    principal: Principal = Depends(get_current_principal),
 ):
     # Simplified: Create a new Test Premium subscription on every call
-    sub = Subscription(
-        user_id=current_user.id,
+    entitlement = await record_subscription(
+        session,
+        principal.user_id,
         is_active=True,
         plan="premium",
         provider="test",
     )
-    session.add(sub)
-    await session.commit()
-    await session.refresh(sub)
+    note_user_write(principal.user_id)
+    return SubscriptionStatus(**entitlement)
+
+
+async def _activate_plan(model, user_id: int, values: dict, session: AsyncSession):
+    """
+    Deactivate the user's current plan and insert the new active one in one
+    transaction (UPDATE ... WHERE active, then INSERT ... RETURNING).
 
-    return SubscriptionStatus(
-        is_active=sub.is_active,
-        plan=sub.plan,
-        provider=sub.provider,
+    The partial unique index on (user_id) WHERE active guarantees a single
+    active plan; a concurrent save that loses the race is simply retried.
+    """
+    for attempt in range(3):
+        try:
+            await session.execute(
+                update(model)
+                .where(model.user_id == user_id, model.active == True)
+                .values(active=False)
+            )
+            result = await session.scalars(
+                insert(model).values(user_id=user_id, active=True, **values).returning(model)
+            )
+            plan = result.one()
+            await session.commit()
+            note_user_write(user_id)
+            return plan
+        except IntegrityError:
+            await session.rollback()
+            if attempt == 2:
+                raise
+
+
+async def _current_plan(model, user_id: int, session: AsyncSession):
+    # بحث مباشر في الفهرس uq_*_active_user (خطة نشطة وحدة فقط)
+    result = await session.execute(
+        select(model).where(model.user_id == user_id, model.active == True)
     )
+    return result.scalar_one_or_none()
 
 
 @app.post("/plans/workout", response_model=WorkoutPlanRead)
 async def save_workout_plan(
     payload: WorkoutPlanCreate,
     session: AsyncSession = Depends(get_session),
-    current_user: User = Depends(get_current_user),
+    principal: Principal = Depends(get_current_principal),
 ):
-    stmt = (
-        select(WorkoutPlan)
-        .where(WorkoutPlan.user_id == current_user.id, WorkoutPlan.active == True)
-        .order_by(WorkoutPlan.created_at.desc())
-        .limit(1)
-    )
-    result = await session.execute(stmt)
-    prev = result.scalar_one_or_none()
-    if prev:
-        prev.active = False
-        session.add(prev)
-
-    plan = WorkoutPlan(
-        user_id=current_user.id,
-        duration_weeks=payload.duration_weeks,
-        focus=payload.focus,
-        active=True,
+    return await _activate_plan(
+        WorkoutPlan,
+        principal.user_id,
+        {
+            "duration_weeks": payload.duration_weeks,
+            "focus": payload.focus,
+        },
+        session,
     )
-    session.add(plan)
-    await session.commit()
-    await session.refresh(plan)
-    return plan
 
 
 @app.get("/plans/workout/current", response_model=WorkoutPlanRead)
 async def get_current_workout_plan(
-    session: AsyncSession = Depends(get_session),
-    current_user: User = Depends(get_current_user),
+    session: AsyncSession = Depends(get_read_session),
+    principal: Principal = Depends(get_current_principal),
 ):
-    stmt = (
-        select(WorkoutPlan)
-        .where(WorkoutPlan.user_id == current_user.id, WorkoutPlan.active == True)
-        .order_by(WorkoutPlan.created_at.desc())
-        .limit(1)
-    )
-    result = await session.execute(stmt)
-    plan = result.scalar_one_or_none()
+    plan = await _current_plan(WorkoutPlan, principal.user_id, session)
     if not plan:
         raise HTTPException(status_code=404, detail="No active workout plan")
     return plan
@@ -857,47 +1319,27 @@ async def get_current_workout_plan(
 async def save_meal_plan(
     payload: MealPlanCreate,
     session: AsyncSession = Depends(get_session),
-    current_user: User = Depends(get_current_user),
+    principal: Principal = Depends(get_current_principal),
 ):
-    stmt = (
-        select(MealPlan)
-        .where(MealPlan.user_id == current_user.id, MealPlan.active == True)
-        .order_by(MealPlan.created_at.desc())
-        .limit(1)
-    )
-    result = await session.execute(stmt)
-    prev = result.scalar_one_or_none()
-    if prev:
-        prev.active = False
-        session.add(prev)
-
-    plan = MealPlan(
-        user_id=current_user.id,
-        calories_target=payload.calories_target,
-        protein=payload.protein,
-        carbs=payload.carbs,
-        fats=payload.fats,
-        active=True,
+    return await _activate_plan(
+        MealPlan,
+        principal.user_id,
+        {
+            "calories_target": payload.calories_target,
+            "protein": payload.protein,
+            "carbs": payload.carbs,
+            "fats": payload.fats,
+        },
+        session,
     )
-    session.add(plan)
-    await session.commit()
-    await session.refresh(plan)
-    return plan
 
 
 @app.get("/plans/meal/current", response_model=MealPlanRead)
 async def get_current_meal_plan(
-    session: AsyncSession = Depends(get_session),
-    current_user: User = Depends(get_current_user),
+    session: AsyncSession = Depends(get_read_session),
+    principal: Principal = Depends(get_current_principal),
 ):
-    stmt = (
-        select(MealPlan)
-        .where(MealPlan.user_id == current_user.id, MealPlan.active == True)
-        .order_by(MealPlan.created_at.desc())
-        .limit(1)
-    )
-    result = await session.execute(stmt)
-    plan = result.scalar_one_or_none()
+    plan = await _current_plan(MealPlan, principal.user_id, session)
     if not plan:
         raise HTTPException(status_code=404, detail="No active meal plan")
     return plan
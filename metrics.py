@@ -0,0 +1,355 @@
+# metrics.py
+#
+# Metrics بصيغة Prometheus (text exposition format) بدون مكتبات خارجية.
+# الهدف: تكلفة قليلة جدًا لكل عملية (قفل + عملية bisect) حتى تبقى شغالة دائمًا.
+
+import bisect
+import hmac
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from fastapi import HTTPException, Request, status
+from fastapi.responses import PlainTextResponse
+from starlette.routing import Match
+
+LabelValues = Tuple[str, ...]
+
+# حدود الـ buckets بالثواني: من 1ms لين 30s
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+)
+
+# توكن /metrics وروابط الـ stats، يوصل كـ Authorization: Bearer (bearer_token في
+# scrape_config حق Prometheus). لو فاضي الروابط مفتوحة ولازم تنحجب من الـ proxy.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+_registry: List["_Metric"] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    type_name = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} {self.type_name}",
+        ]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> Iterable[str]:
+        return []
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, help_text, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self) -> Iterable[str]:
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Gauge(Counter):
+    type_name = "gauge"
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # لكل مجموعة labels: [عدد كل bucket (غير تراكمي)..., +Inf], المجموع, العدد
+        self._values: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def _samples(self) -> Iterable[str]:
+        with self._lock:
+            items = [(key, list(e[0]), e[1], e[2]) for key, e in self._values.items()]
+        for key, counts, total, count in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = f'le="{_format_value(bound)}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {count}"
+
+
+class CallbackMetric(_Metric):
+    """Metric whose samples are read from a callback at scrape time.
+
+    The callback returns ``[(label_values, value), ...]``; use this for
+    values other modules already track (pool sizes, cache counters...).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        callback: Callable[[], Iterable[Tuple[LabelValues, float]]],
+        labelnames: Sequence[str] = (),
+        type_name: str = "gauge",
+    ) -> None:
+        super().__init__(name, help_text, labelnames)
+        self.callback = callback
+        self.type_name = type_name
+
+    def _samples(self) -> Iterable[str]:
+        for key, value in self.callback():
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+def render() -> str:
+    lines: List[str] = []
+    for metric in _registry:
+        try:
+            lines.extend(metric.render())
+        except Exception:
+            # callback معطوب ما يكسر الـ scrape كامل
+            continue
+    return "\n".join(lines) + "\n"
+
+
+def metrics_response() -> PlainTextResponse:
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def require_metrics_token(request: Request) -> None:
+    """Dependency guarding /metrics and the stats routes when METRICS_TOKEN is set."""
+    if not METRICS_TOKEN:
+        return
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    # مقارنة بزمن ثابت، مثل X-Profile-Token
+    if scheme.lower() != "bearer" or not hmac.compare_digest(
+        token.strip().encode("latin-1"), METRICS_TOKEN.encode()
+    ):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+
+
+# ------------- HTTP --------------
+
+http_request_seconds = Histogram(
+    "bodytalk_http_request_duration_seconds",
+    "HTTP request latency by route template, method and status code.",
+    ("method", "route", "status"),
+)
+http_requests_in_flight = Gauge(
+    "bodytalk_http_requests_in_flight",
+    "HTTP requests currently being served, by method and route.",
+    ("method", "route"),
+)
+
+
+def _match_route(scope) -> str:
+    """Route template for a request before routing runs (same label as the histogram)."""
+    app = scope.get("app")
+    for route in getattr(getattr(app, "router", None), "routes", ()):
+        match, _ = route.matches(scope)
+        if match != Match.NONE:
+            return getattr(route, "path", None) or "unmatched"
+    return "unmatched"
+
+
+class MetricsMiddleware:
+    """Records latency per route template (not raw path, to bound cardinality)."""
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        in_flight_route = _match_route(scope)
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        http_requests_in_flight.inc(method=method, route=in_flight_route)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            http_requests_in_flight.dec(method=method, route=in_flight_route)
+            route = scope.get("route")
+            http_request_seconds.observe(
+                elapsed,
+                method=method,
+                route=getattr(route, "path", None) or "unmatched",
+                status=str(status_code),
+            )
+
+
+# ------------- Analysis --------------
+
+analysis_stage_seconds = Histogram(
+    "bodytalk_analysis_stage_seconds",
+    "Duration of analysis pipeline stages (ingest, decode, features, db_write...).",
+    ("pipeline", "stage"),
+)
+
+
+# ------------- Database --------------
+
+db_query_seconds = Histogram(
+    "bodytalk_db_query_duration_seconds",
+    "SQL statement execution time by statement type.",
+    ("operation",),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0),
+)
+db_query_errors = Counter(
+    "bodytalk_db_query_errors_total",
+    "SQL statements that raised an error, by statement type.",
+    ("operation",),
+)
+
+
+def _statement_operation(statement: str) -> str:
+    word = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+    return word if word in ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH") else "OTHER"
+
+
+def instrument_engine(engine) -> None:
+    """Attach query timing events and pool gauges to an AsyncEngine."""
+    from sqlalchemy import event
+
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("_metrics_query_start", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get("_metrics_query_start")
+        if starts:
+            db_query_seconds.observe(
+                time.perf_counter() - starts.pop(),
+                operation=_statement_operation(statement),
+            )
+
+    @event.listens_for(sync_engine, "handle_error")
+    def _error(exception_context):
+        conn = exception_context.connection
+        if conn is not None:
+            starts = conn.info.get("_metrics_query_start")
+            if starts:
+                starts.pop()
+        db_query_errors.inc(operation=_statement_operation(exception_context.statement or ""))
+
+    pool = sync_engine.pool
+
+    def _pool_samples():
+        samples = []
+        for name in ("size", "checkedout", "checkedin", "overflow"):
+            fn = getattr(pool, name, None)
+            if callable(fn):
+                samples.append(((name,), fn()))
+        return samples
+
+    CallbackMetric(
+        "bodytalk_db_pool_connections",
+        "Connection pool state (size, checkedout, checkedin, overflow).",
+        _pool_samples,
+        ("state",),
+    )
+
+
+# ------------- Passwords --------------
+
+password_hash_seconds = Histogram(
+    "bodytalk_password_hash_duration_seconds",
+    "bcrypt time spent hashing and verifying passwords.",
+    ("operation",),
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 2.0),
+)
+
+
+def stats_metric(name: str, help_text: str, stats: Callable[[], dict], keys: Optional[Sequence[str]] = None) -> None:
+    """Expose the numeric fields of a ``stats()`` dict as ``name{field=...}``."""
+
+    def samples():
+        data = stats()
+        return [
+            ((key,), value)
+            for key, value in data.items()
+            if (keys is None or key in keys) and isinstance(value, (int, float)) and not isinstance(value, bool)
+        ]
+
+    CallbackMetric(name, help_text, samples, ("field",))
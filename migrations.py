@@ -0,0 +1,263 @@
+# migrations.py
+#
+# Migrations بسيطة بأرقام إصدار، محفوظة في جدول schema_migrations.
+# كل migration تتنفذ مرة وحدة بس، ولازم تكون idempotent (IF NOT EXISTS...)
+# لأن 0001 ينشئ الجداول من models.py الحالية على قاعدة جديدة.
+#
+# التشغيل (قبل تشغيل uvicorn، مرة وحدة لكل deploy):
+#   python migrations.py
+#   python migrations.py --status
+#
+# مع AUTO_MIGRATE=true (الافتراضي، للتطوير المحلي) التطبيق يشغلها عند startup.
+#
+# على Postgres الفهارس تنبني بـ CREATE INDEX CONCURRENTLY (بدون قفل الكتابة على
+# الجدول)، فكل شي هنا يشتغل بـ AUTOCOMMIT وليس داخل transaction.
+
+import argparse
+import asyncio
+import logging
+import os
+import re
+from datetime import datetime
+from typing import Awaitable, Callable, List, Tuple
+
+from sqlalchemy import Index, func, insert, select, text, update
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+from sqlalchemy.schema import CreateIndex
+
+from db import Base, engine
+from models import (
+    ACTIVE_ONLY,
+    MealPlan,
+    Subscription,
+    SubscriptionHistory,
+    UserEntitlement,
+    WorkoutPlan,
+)
+
+logger = logging.getLogger("bodytalk.migrations")
+
+# تشغيل الـ migrations تلقائيًا عند startup
+AUTO_MIGRATE = os.getenv("AUTO_MIGRATE", "true").lower() in ("1", "true", "yes")
+
+# مفتاح pg_advisory_lock حتى لو بدأت عدة instances مع بعض وحدة بس تطبق
+_ADVISORY_LOCK_KEY = 0x626F6479  # "body"
+
+Migration = Tuple[str, str, Callable[[AsyncConnection], Awaitable[None]]]
+
+
+def _is_postgres(conn: AsyncConnection) -> bool:
+    return conn.dialect.name == "postgresql"
+
+
+async def create_index(conn: AsyncConnection, index: Index) -> None:
+    """CREATE INDEX IF NOT EXISTS, online (CONCURRENTLY) on Postgres."""
+    ddl = str(CreateIndex(index, if_not_exists=True).compile(dialect=conn.dialect))
+    if _is_postgres(conn):
+        # بناء CONCURRENTLY اللي فشل يخلي فهرس INVALID؛ IF NOT EXISTS راح يتجاهله
+        invalid = await conn.scalar(
+            text(
+                "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+                "WHERE c.relname = :name AND NOT i.indisvalid"
+            ),
+            {"name": index.name},
+        )
+        if invalid:
+            await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {index.name}"))
+        ddl = re.sub(r"^CREATE (UNIQUE )?INDEX ", r"CREATE \1INDEX CONCURRENTLY ", ddl)
+    await conn.execute(text(ddl))
+
+
+async def drop_index(conn: AsyncConnection, name: str) -> None:
+    concurrently = "CONCURRENTLY " if _is_postgres(conn) else ""
+    await conn.execute(text(f"DROP INDEX {concurrently}IF EXISTS {name}"))
+
+
+def _model_index(table: str, name: str) -> Index:
+    for index in Base.metadata.tables[table].indexes:
+        if index.name == name:
+            return index
+    raise KeyError(name)
+
+
+def _index(table: str, name: str, *columns: str, **kwargs) -> Index:
+    """An index as it was at the time of a migration, detached from the models."""
+    table_obj = Base.metadata.tables[table]
+    index = Index(name, *(table_obj.c[column] for column in columns), **kwargs)
+    table_obj.indexes.discard(index)
+    return index
+
+
+# ------------- Migrations --------------
+
+async def _0001_initial_schema(conn: AsyncConnection) -> None:
+    await conn.run_sync(Base.metadata.create_all)
+
+
+async def _0002_history_and_plan_indexes(conn: AsyncConnection) -> None:
+    for table, name in (
+        ("subscriptions", "ix_subscriptions_user_created"),
+        ("workout_plans", "ix_workout_plans_user_created"),
+        ("meal_plans", "ix_meal_plans_user_created"),
+    ):
+        await create_index(conn, _model_index(table, name))
+    # استبدلها 0005 بفهارس فيها id
+    for table in ("body_analyses", "food_analyses"):
+        await create_index(
+            conn,
+            _index(table, f"ix_{table}_user_created", "user_id", "created_at"),
+        )
+    # استبدلها 0003 بفهارس unique
+    for table in ("workout_plans", "meal_plans"):
+        await create_index(
+            conn,
+            _index(table, f"ix_{table}_user_active", "user_id", "created_at", **ACTIVE_ONLY),
+        )
+
+
+async def _0003_one_active_plan_per_user(conn: AsyncConnection) -> None:
+    for model in (WorkoutPlan, MealPlan):
+        # أي مستخدم عنده أكثر من خطة نشطة (من الحفظ المتزامن القديم): نخلي الأحدث بس
+        newest_active = (
+            select(func.max(model.id))
+            .where(model.active == True)
+            .group_by(model.user_id)
+        )
+        await conn.execute(
+            update(model)
+            .where(model.active == True, model.id.not_in(newest_active))
+            .values(active=False)
+        )
+        table = model.__tablename__
+        await create_index(conn, _model_index(table, f"uq_{table}_active_user"))
+        await drop_index(conn, f"ix_{table}_user_active")
+
+
+async def _0004_user_entitlements(conn: AsyncConnection) -> None:
+    tables = [UserEntitlement.__table__, SubscriptionHistory.__table__]
+    await conn.run_sync(lambda sync_conn: Base.metadata.create_all(sync_conn, tables=tables))
+    # الحالة الحالية = أحدث صف في subscriptions لكل مستخدم (نفس ترتيب الـ compaction)
+    latest = (
+        select(func.max(Subscription.id))
+        .group_by(Subscription.user_id)
+    )
+    await conn.execute(
+        insert(UserEntitlement).from_select(
+            ["user_id", "subscription_id", "is_active", "plan", "provider", "updated_at"],
+            select(
+                Subscription.user_id,
+                Subscription.id,
+                func.coalesce(Subscription.is_active, False),
+                Subscription.plan,
+                Subscription.provider,
+                func.coalesce(Subscription.created_at, func.current_timestamp()),
+            ).where(
+                Subscription.id.in_(latest),
+                Subscription.user_id.not_in(select(UserEntitlement.user_id)),
+            ),
+        )
+    )
+
+
+async def _0005_history_keyset_indexes(conn: AsyncConnection) -> None:
+    # استبدلها 0006 بفهارس على (user_id, id)
+    for table in ("body_analyses", "food_analyses"):
+        await create_index(
+            conn,
+            _index(table, f"ix_{table}_user_created_id", "user_id", "created_at", "id"),
+        )
+        await drop_index(conn, f"ix_{table}_user_created")
+
+
+async def _0006_history_id_indexes(conn: AsyncConnection) -> None:
+    for table in ("body_analyses", "food_analyses"):
+        await create_index(conn, _model_index(table, f"ix_{table}_user_id"))
+        await drop_index(conn, f"ix_{table}_user_created_id")
+
+
+MIGRATIONS: List[Migration] = [
+    ("0001", "initial schema", _0001_initial_schema),
+    ("0002", "user/created_at and active plan indexes", _0002_history_and_plan_indexes),
+    ("0003", "one active plan per user", _0003_one_active_plan_per_user),
+    ("0004", "materialized user entitlements", _0004_user_entitlements),
+    ("0005", "history keyset indexes on (user_id, created_at, id)", _0005_history_keyset_indexes),
+    ("0006", "history keyset indexes on (user_id, id)", _0006_history_id_indexes),
+]
+
+
+# ------------- Runner --------------
+
+async def _applied_versions(conn: AsyncConnection) -> set:
+    await conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "version VARCHAR(32) PRIMARY KEY, "
+        "description VARCHAR(255) NOT NULL, "
+        "applied_at TIMESTAMP NOT NULL)"
+    ))
+    result = await conn.execute(text("SELECT version FROM schema_migrations"))
+    return {row[0] for row in result}
+
+
+async def migrate(db_engine: AsyncEngine = engine) -> List[str]:
+    """Apply pending migrations in order; returns the versions applied."""
+    applied_now = []
+    async with db_engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        if _is_postgres(conn):
+            # DB_STATEMENT_TIMEOUT_MS للطلبات؛ بناء فهرس CONCURRENTLY على جدول كبير (أو
+            # انتظار instance ثانية على القفل) ياخذ أكثر بكثير، والإلغاء يخلي فهرس INVALID
+            await conn.execute(text("SET statement_timeout = 0"))
+            await conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": _ADVISORY_LOCK_KEY})
+        try:
+            applied = await _applied_versions(conn)
+            for version, description, apply in MIGRATIONS:
+                if version in applied:
+                    continue
+                logger.info("Applying migration %s: %s", version, description)
+                await apply(conn)
+                await conn.execute(
+                    text(
+                        "INSERT INTO schema_migrations (version, description, applied_at) "
+                        "VALUES (:version, :description, :applied_at)"
+                    ),
+                    {"version": version, "description": description, "applied_at": datetime.utcnow()},
+                )
+                applied_now.append(version)
+        finally:
+            if _is_postgres(conn):
+                await conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": _ADVISORY_LOCK_KEY})
+                # الاتصال يرجع للـ pool: نرجع الـ timeout الافتراضي من server_settings
+                await conn.execute(text("RESET statement_timeout"))
+    return applied_now
+
+
+async def pending_migrations(db_engine: AsyncEngine = engine) -> List[str]:
+    async with db_engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        applied = await _applied_versions(conn)
+    return [version for version, _, _ in MIGRATIONS if version not in applied]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Apply BodyTalk database migrations")
+    parser.add_argument("--status", action="store_true", help="only list pending migrations")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    async def run() -> None:
+        try:
+            if args.status:
+                pending = await pending_migrations()
+                print("pending:", ", ".join(pending) if pending else "none")
+            else:
+                applied = await migrate()
+                print("applied:", ", ".join(applied) if applied else "nothing to do")
+        finally:
+            await engine.dispose()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -8,12 +8,22 @@ from sqlalchemy import (
     Float,
     Boolean,
     ForeignKey,
+    Index,
+    text,
 )
 from sqlalchemy.orm import relationship
 
 from db import Base
 
 
+# الخطة النشطة فقط (WHERE active): فهرس unique صغير يضمن خطة نشطة وحدة لكل مستخدم،
+# و /plans/*/current تصير بحث مباشر فيه
+ACTIVE_ONLY = {
+    "postgresql_where": text("active"),
+    "sqlite_where": text("active = 1"),
+}
+
+
 class User(Base):
     __tablename__ = "users"
 
@@ -45,6 +55,10 @@ class User(Base):
 
 class BodyAnalysis(Base):
     __tablename__ = "body_analyses"
+    __table_args__ = (
+        # سجل المستخدم: WHERE user_id = ? AND id < cursor ORDER BY id DESC
+        Index("ix_body_analyses_user_id", "user_id", "id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=True)
@@ -61,6 +75,9 @@ class BodyAnalysis(Base):
 
 class FoodAnalysis(Base):
     __tablename__ = "food_analyses"
+    __table_args__ = (
+        Index("ix_food_analyses_user_id", "user_id", "id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=True)
@@ -77,6 +94,9 @@ class FoodAnalysis(Base):
 
 class Subscription(Base):
     __tablename__ = "subscriptions"
+    __table_args__ = (
+        Index("ix_subscriptions_user_created", "user_id", "created_at"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
@@ -91,6 +111,10 @@ class Subscription(Base):
 
 class WorkoutPlan(Base):
     __tablename__ = "workout_plans"
+    __table_args__ = (
+        Index("ix_workout_plans_user_created", "user_id", "created_at"),
+        Index("uq_workout_plans_active_user", "user_id", unique=True, **ACTIVE_ONLY),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
@@ -105,6 +129,10 @@ class WorkoutPlan(Base):
 
 class MealPlan(Base):
     __tablename__ = "meal_plans"
+    __table_args__ = (
+        Index("ix_meal_plans_user_created", "user_id", "created_at"),
+        Index("uq_meal_plans_active_user", "user_id", unique=True, **ACTIVE_ONLY),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
@@ -117,3 +145,53 @@ class MealPlan(Base):
     active = Column(Boolean, default=True)
 
     user = relationship("User", back_populates="meal_plans")
+
+
+class UserEntitlement(Base):
+    """The user's current subscription, one row per user.
+
+    Written in the same transaction as every new ``Subscription`` row, so the
+    premium check is a primary-key lookup instead of a scan of the history.
+    """
+
+    __tablename__ = "user_entitlements"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    # الصف الحالي في subscriptions؛ كل اللي قبله للمستخدم قديم ويتجمع في subscription_history
+    subscription_id = Column(Integer, ForeignKey("subscriptions.id"), nullable=False)
+    is_active = Column(Boolean, nullable=False, default=False)
+    plan = Column(String(50), nullable=True)
+    provider = Column(String(50), nullable=True)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+
+class SubscriptionHistory(Base):
+    """Superseded subscription rows, collapsed by the compaction job.
+
+    One row stands for ``rows_merged`` old ``subscriptions`` rows with the
+    same state, created between ``first_at`` and ``last_at``.
+    """
+
+    __tablename__ = "subscription_history"
+    __table_args__ = (
+        Index("ix_subscription_history_user_first", "user_id", "first_at"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    is_active = Column(Boolean, nullable=True)
+    plan = Column(String(50), nullable=True)
+    provider = Column(String(50), nullable=True)
+    external_id = Column(String(255), nullable=True)
+    first_at = Column(DateTime, nullable=True)
+    last_at = Column(DateTime, nullable=True)
+    rows_merged = Column(Integer, nullable=False, default=1)
+
+
+class TokenRevocation(Base):
+    """Tokens of ``user_id`` issued before ``revoked_before`` are rejected."""
+
+    __tablename__ = "token_revocations"
+
+    user_id = Column(Integer, primary_key=True)
+    revoked_before = Column(DateTime, nullable=False, default=datetime.utcnow)
@@ -0,0 +1,49 @@
+# pagination.py
+#
+# Keyset pagination لسجلات التحليل: الـ cursor هو id آخر صف في الصفحة، فالصفحة
+# التالية = WHERE id < cursor، بدون OFFSET. الترتيب بالـ id (وليس created_at)
+# لأن الـ id يزيد مع ترتيب الإضافة دائمًا، بينما created_at وقت الطلب وصف
+# متأخر من الـ write-behind ممكن يكون أقدم من cursor الـ since عند العميل.
+# السجلات تنضاف فقط (ما في تعديل أو حذف)، فمحتوى أي طلب يتحدد بالكامل من
+# أحدث صف للمستخدم، وهذا أساس الـ ETag.
+
+import base64
+import hashlib
+import os
+from typing import Optional
+
+from fastapi import HTTPException, status
+
+# حجم الصفحة الافتراضي (نفس الحد القديم 100) والأقصى
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "100"))
+HISTORY_MAX_PAGE_SIZE = int(os.getenv("HISTORY_MAX_PAGE_SIZE", "500"))
+
+def encode_cursor(row_id: int) -> str:
+    return base64.urlsafe_b64encode(str(row_id).encode()).decode().rstrip("=")
+
+
+def decode_cursor(value: Optional[str], param: str = "cursor") -> Optional[int]:
+    if not value:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(value + "=" * (-len(value) % 4)).decode()
+        # cursors قديمة عند العملاء كانت "created_at|id"؛ الـ id وحده يكفي
+        return int(raw.rsplit("|", 1)[-1])
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid {param}.",
+        )
+
+
+def history_etag(kind: str, latest: Optional[int], *params) -> str:
+    """Weak ETag for one history response: the user's newest row id plus the query."""
+    key = "|".join([kind, str(latest) if latest else "-"] + [str(p) for p in params])
+    return 'W/"' + hashlib.sha1(key.encode()).hexdigest()[:20] + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
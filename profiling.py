@@ -0,0 +1,257 @@
+# profiling.py
+#
+# Profiling عند الطلب: لطلب معيّن (header خاص) أو لنسبة عشوائية من الطلبات،
+# نشغّل sampler يقرأ stacks كل الـ threads كل بضع ميلي ثواني طول مدة الطلب،
+# ونحفظ النتيجة كـ collapsed stacks (جاهزة لـ flamegraph.pl / speedscope)
+# مع ملخص: وقت الانتظار (DB / الشبكة) مقابل PIL و NumPy و bcrypt.
+#
+# مطفي افتراضيًا: لو PROFILE_TOKEN و PROFILE_SAMPLE_RATE فاضيين الـ middleware
+# ما ينضاف أصلًا، فما في أي تكلفة.
+
+import hmac
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from datetime import datetime
+from typing import Callable, Deque, Dict, List, Optional
+
+from fastapi import HTTPException, Request, status
+from fastapi.responses import PlainTextResponse
+
+
+# القيمة المطلوبة في X-Profile-Token لتفعيل الـ profiling وللوصول لـ /admin/profiles
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+# نسبة الطلبات اللي تنعمل لها profile تلقائيًا (0 = بس اللي معها الـ header)
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+# الفاصل بين كل عينة والثانية (ميلي ثانية)
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+# عدد الـ profiles المحفوظة في الذاكرة (الأقدم ينحذف)
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "20"))
+
+PROFILE_HEADER = b"x-profile-token"
+PROFILE_EXCLUDED_PREFIXES = ("/metrics", "/admin/profiles")
+
+# أول module يطابق من الـ leaf للأعلى يحدد تصنيف العينة
+_CATEGORIES = (
+    ("bcrypt", ("passlib", "bcrypt", "_bcrypt")),
+    ("image", ("PIL", "numpy", "analysis", "image_features")),
+    ("db", ("sqlalchemy", "aiosqlite", "asyncpg", "sqlite3", "psycopg", "psycopg2")),
+)
+
+
+def profiling_enabled() -> bool:
+    return bool(PROFILE_TOKEN) or PROFILE_SAMPLE_RATE > 0
+
+
+def _frame_label(frame) -> str:
+    module = frame.f_globals.get("__name__", "?")
+    return f"{module}:{frame.f_code.co_qualname}"
+
+
+def _categorize(labels: List[str], on_loop: bool) -> str:
+    for label in reversed(labels):
+        top = label.split(":", 1)[0].split(".", 1)[0]
+        for category, modules in _CATEGORIES:
+            if top in modules:
+                return category
+    if on_loop and labels and labels[-1].startswith("selectors:"):
+        # الـ event loop فاضي ينتظر I/O (رد قاعدة البيانات، الشبكة، أو worker)
+        return "io_wait"
+    return "other"
+
+
+def _thread_role(name: str) -> str:
+    # analysis_0 و analysis_3 -> analysis
+    return re.sub(r"[-_]\d+(_\d+)?$", "", name) or "thread"
+
+
+class RequestProfile:
+    def __init__(self, method: str, path: str, interval: float) -> None:
+        self.id = uuid.uuid4().hex[:12]
+        self.created_at = datetime.utcnow()
+        self.method = method
+        self.path = path
+        self.route: Optional[str] = None
+        self.status: Optional[int] = None
+        self.duration_ms = 0.0
+        self.interval = interval
+        self.samples = 0
+        self.stacks: Counter = Counter()
+        self.categories: Counter = Counter()
+
+    def add_sample(self, loop_thread: int, sampler_thread: int, busy: Callable[[int], bool]) -> None:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        self.samples += 1
+        for ident, frame in sys._current_frames().items():
+            if ident == sampler_thread:
+                continue
+            on_loop = ident == loop_thread
+            # threads الثانية (pool, aiosqlite...) نحسبها بس لما تستهلك CPU فعلًا،
+            # لأن الـ stack حقها وهي تنتظر في C يشبه الـ stack وهي تشتغل
+            if not on_loop and not busy(ident):
+                continue
+
+            labels = []
+            while frame is not None:
+                labels.append(_frame_label(frame))
+                frame = frame.f_back
+            labels.reverse()
+
+            category = _categorize(labels, on_loop)
+            if not on_loop and category == "other":
+                continue
+
+            role = "event-loop" if on_loop else _thread_role(names.get(ident, "thread"))
+            self.stacks[";".join([role] + labels)] += 1
+            self.categories[category] += 1
+
+    def _ms(self, samples: int) -> float:
+        return round(samples * self.interval * 1000, 1)
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def summary(self, top: int = 0) -> dict:
+        data = {
+            "id": self.id,
+            "created_at": self.created_at.isoformat(),
+            "method": self.method,
+            "path": self.path,
+            "route": self.route,
+            "status": self.status,
+            "duration_ms": self.duration_ms,
+            "samples": self.samples,
+            "interval_ms": self.interval * 1000,
+            # تقريبي: عدد العينات × الفاصل. threads الـ pool تُحسب مع الـ loop
+            # فالمجموع ممكن يتجاوز مدة الطلب
+            "categories_ms": {k: self._ms(v) for k, v in self.categories.most_common()},
+        }
+        if top:
+            leaves: Counter = Counter()
+            for stack, count in self.stacks.items():
+                leaves[stack.rsplit(";", 1)[-1]] += count
+            data["top_functions_ms"] = [
+                {"function": name, "ms": self._ms(count)} for name, count in leaves.most_common(top)
+            ]
+            data["top_stacks_ms"] = [
+                {"stack": stack.split(";"), "ms": self._ms(count)}
+                for stack, count in self.stacks.most_common(top)
+            ]
+        return data
+
+
+class _Sampler(threading.Thread):
+    def __init__(self, profile: RequestProfile, loop_thread: int) -> None:
+        super().__init__(name="profiler", daemon=True)
+        self.profile = profile
+        self.loop_thread = loop_thread
+        self.stopped = threading.Event()
+
+        self._cpu: Dict[int, float] = {}
+
+    def _busy(self, ident: int) -> bool:
+        """True when the thread used CPU since the previous sample."""
+        try:
+            cpu = time.clock_gettime(time.pthread_getcpuclockid(ident))
+        except (AttributeError, OSError):
+            return True  # ما في ساعة CPU لكل thread (مثلًا Windows)
+        previous = self._cpu.get(ident)
+        self._cpu[ident] = cpu
+        return previous is not None and cpu - previous > self.profile.interval / 4
+
+    def run(self) -> None:
+        me = threading.get_ident()
+        while not self.stopped.wait(self.profile.interval):
+            self.profile.add_sample(self.loop_thread, me, self._busy)
+
+
+profiles: Deque[RequestProfile] = deque(maxlen=PROFILE_KEEP)
+# الـ sampler يقرأ كل الـ process، فـ profile واحد بس في نفس الوقت
+_active = threading.Lock()
+
+
+def _token_matches(value: bytes) -> bool:
+    # مقارنة بزمن ثابت حتى ما ينكشف التوكن حرف حرف من زمن الرد
+    return bool(PROFILE_TOKEN) and hmac.compare_digest(value, PROFILE_TOKEN.encode())
+
+
+class ProfilingMiddleware:
+    """Samples the stacks of all threads while an opted-in request runs.
+
+    Only one request is profiled at a time; other requests running at the
+    same moment show up in the event loop samples too. With the process
+    pool the image work happens in other processes and is not sampled.
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    def _wants_profile(self, scope) -> bool:
+        if scope["path"].startswith(PROFILE_EXCLUDED_PREFIXES):
+            return False
+        if PROFILE_TOKEN:
+            for name, value in scope["headers"]:
+                if name == PROFILE_HEADER:
+                    return _token_matches(value)
+        return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or not self._wants_profile(scope)
+            or not _active.acquire(blocking=False)
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile(scope["method"], scope["path"], PROFILE_INTERVAL_MS / 1000)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                profile.status = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"x-profile-id", profile.id.encode()),
+                ]
+            await send(message)
+
+        sampler = _Sampler(profile, threading.get_ident())
+        start = time.perf_counter()
+        sampler.start()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            sampler.stopped.set()
+            sampler.join()
+            profile.duration_ms = round((time.perf_counter() - start) * 1000, 1)
+            route = scope.get("route")
+            profile.route = getattr(route, "path", None)
+            profiles.append(profile)
+            _active.release()
+
+
+# ------------- Admin Routes --------------
+
+def require_profile_token(request: Request) -> None:
+    """Dependency guarding /admin/profiles with the same token header."""
+    token = request.headers.get("x-profile-token")
+    if not PROFILE_TOKEN or token is None or not _token_matches(token.encode("latin-1")):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+
+
+def find_profile(profile_id: str) -> RequestProfile:
+    for profile in profiles:
+        if profile.id == profile_id:
+            return profile
+    raise HTTPException(status_code=404, detail="Profile not found or expired.")
+
+
+def collapsed_response(profile: RequestProfile) -> PlainTextResponse:
+    return PlainTextResponse(
+        profile.collapsed(),
+        headers={"Content-Disposition": f'attachment; filename="profile-{profile.id}.folded"'},
+    )
@@ -0,0 +1,205 @@
+# subscriptions.py
+#
+# حالة الاشتراك الحالية لكل مستخدم محفوظة في user_entitlements (صف واحد لكل
+# مستخدم) وتتحدث في نفس transaction اللي تضيف صف في subscriptions، فـ
+# /subscriptions/me يصير بحث بالـ primary key (ومعظم الوقت من الكاش) بدل
+# ORDER BY created_at DESC على كل صفوف المستخدم.
+#
+# subscriptions يظل سجل append-only، وعملية compaction بالخلفية تجمع الصفوف
+# القديمة (كل شي قبل الصف الحالي للمستخدم) في subscription_history وتحذفها.
+#
+# الكاش لكل process: التفعيل يحذف مفتاح المستخدم فورًا، ومع عدة workers
+# ENTITLEMENT_CACHE_TTL هو أقصى مدة لحالة قديمة.
+
+import asyncio
+import logging
+import os
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from cache import LRUCache
+from db import AsyncSessionLocal
+from models import Subscription, SubscriptionHistory, UserEntitlement
+
+logger = logging.getLogger("bodytalk.subscriptions")
+
+# عدد المستخدمين في الكاش (0 = تعطيل) وعمر العنصر بالثواني
+ENTITLEMENT_CACHE_SIZE = int(os.getenv("ENTITLEMENT_CACHE_SIZE", "4096"))
+ENTITLEMENT_CACHE_TTL = float(os.getenv("ENTITLEMENT_CACHE_TTL", "60"))
+# كل كم ثانية تشتغل الـ compaction (0 = بدون)
+SUBSCRIPTION_COMPACT_SECONDS = float(os.getenv("SUBSCRIPTION_COMPACT_SECONDS", "3600"))
+# عدد الصفوف القديمة في كل transaction
+SUBSCRIPTION_COMPACT_BATCH = int(os.getenv("SUBSCRIPTION_COMPACT_BATCH", "1000"))
+
+# مفتاح pg_try_advisory_xact_lock حتى instance وحدة بس تعمل compaction بنفس الوقت
+_COMPACTION_LOCK_KEY = 0x7375627363  # "subsc"
+
+NO_ENTITLEMENT = {"is_active": False, "plan": None, "provider": None}
+
+entitlement_cache = LRUCache(ENTITLEMENT_CACHE_SIZE, ENTITLEMENT_CACHE_TTL)
+
+_compaction_task: Optional[asyncio.Task] = None
+_compaction_stats = {"runs": 0, "rows_compacted": 0, "failures": 0}
+
+
+def _entitlement_values(row) -> dict:
+    return {"is_active": bool(row.is_active), "plan": row.plan, "provider": row.provider}
+
+
+def invalidate_entitlement(user_id: int) -> None:
+    entitlement_cache.invalidate(user_id)
+
+
+async def get_entitlement(user_id: int, session: AsyncSession) -> dict:
+    """The user's current subscription state (``is_active``, ``plan``, ``provider``)."""
+    cached = entitlement_cache.get(user_id)
+    if cached is not None:
+        return cached
+
+    row = await session.get(UserEntitlement, user_id)
+    # المستخدم بدون اشتراك ينحفظ كمان، فالشاشات المجانية ما تسأل القاعدة كل مرة
+    value = _entitlement_values(row) if row is not None else NO_ENTITLEMENT
+    entitlement_cache.set(user_id, value)
+    return value
+
+
+async def record_subscription(session: AsyncSession, user_id: int, **values) -> dict:
+    """Append a subscription row and make it the user's entitlement, in one commit."""
+    sub_id = (
+        await session.execute(
+            insert(Subscription).values(user_id=user_id, **values).returning(Subscription.id)
+        )
+    ).scalar_one()
+
+    dialect = postgresql if session.get_bind().dialect.name == "postgresql" else sqlite
+    upsert = dialect.insert(UserEntitlement).values(
+        user_id=user_id,
+        subscription_id=sub_id,
+        is_active=bool(values.get("is_active")),
+        plan=values.get("plan"),
+        provider=values.get("provider"),
+        updated_at=datetime.utcnow(),
+    )
+    await session.execute(
+        upsert.on_conflict_do_update(
+            index_elements=[UserEntitlement.user_id],
+            set_={
+                column: upsert.excluded[column]
+                for column in ("subscription_id", "is_active", "plan", "provider", "updated_at")
+            },
+            # تفعيلين بنفس اللحظة: الصف الأحدث يفوز مهما كان ترتيب الـ commit
+            where=UserEntitlement.subscription_id < upsert.excluded.subscription_id,
+        )
+    )
+    await session.commit()
+    invalidate_entitlement(user_id)
+    return {
+        "is_active": bool(values.get("is_active")),
+        "plan": values.get("plan"),
+        "provider": values.get("provider"),
+    }
+
+
+# ------------- Compaction --------------
+
+async def compact_subscriptions(batch: int = SUBSCRIPTION_COMPACT_BATCH) -> int:
+    """Collapse superseded ``subscriptions`` rows into ``subscription_history``.
+
+    Rows with the same user and state become one history row; the current
+    row of each user (``user_entitlements.subscription_id``) is never touched.
+    Returns the number of rows removed from ``subscriptions``.
+
+    Every worker runs this on the same schedule. On Postgres each batch
+    takes a transaction-level advisory lock first and the run stops if
+    another worker holds it. On SQLite the history ``INSERT ... SELECT``
+    re-reads the rows under the database write lock, so rows another
+    process has already compacted are skipped, not copied twice.
+    """
+    compacted = 0
+    while True:
+        async with AsyncSessionLocal() as session:
+            if session.get_bind().dialect.name == "postgresql":
+                locked = await session.scalar(
+                    select(func.pg_try_advisory_xact_lock(_COMPACTION_LOCK_KEY))
+                )
+                if not locked:
+                    return compacted
+            ids = (
+                await session.scalars(
+                    select(Subscription.id)
+                    .join(UserEntitlement, UserEntitlement.user_id == Subscription.user_id)
+                    .where(Subscription.id < UserEntitlement.subscription_id)
+                    .order_by(Subscription.id)
+                    .limit(batch)
+                )
+            ).all()
+            if not ids:
+                return compacted
+
+            state = (
+                Subscription.user_id,
+                Subscription.is_active,
+                Subscription.plan,
+                Subscription.provider,
+                Subscription.external_id,
+            )
+            await session.execute(
+                insert(SubscriptionHistory).from_select(
+                    ["user_id", "is_active", "plan", "provider", "external_id",
+                     "first_at", "last_at", "rows_merged"],
+                    select(
+                        *state,
+                        func.min(Subscription.created_at),
+                        func.max(Subscription.created_at),
+                        func.count(),
+                    )
+                    .where(Subscription.id.in_(ids))
+                    .group_by(*state),
+                )
+            )
+            deleted = await session.execute(delete(Subscription).where(Subscription.id.in_(ids)))
+            await session.commit()
+
+        compacted += deleted.rowcount
+        if len(ids) < batch:
+            return compacted
+
+
+async def _compact_periodically() -> None:
+    while True:
+        await asyncio.sleep(SUBSCRIPTION_COMPACT_SECONDS)
+        try:
+            rows = await compact_subscriptions()
+        except Exception:
+            _compaction_stats["failures"] += 1
+            logger.exception("Subscription compaction failed")
+            continue
+        _compaction_stats["runs"] += 1
+        _compaction_stats["rows_compacted"] += rows
+        if rows:
+            logger.info("Compacted %d superseded subscription rows", rows)
+
+
+async def start_subscription_compaction() -> None:
+    global _compaction_task
+    if SUBSCRIPTION_COMPACT_SECONDS > 0 and _compaction_task is None:
+        _compaction_task = asyncio.create_task(_compact_periodically())
+
+
+async def stop_subscription_compaction() -> None:
+    global _compaction_task
+    if _compaction_task is not None:
+        _compaction_task.cancel()
+        try:
+            await _compaction_task
+        except asyncio.CancelledError:
+            pass
+        _compaction_task = None
+
+
+def entitlement_stats() -> dict:
+    return {**entitlement_cache.stats(), **_compaction_stats}
@@ -0,0 +1,75 @@
+# tests/test_write_behind.py
+#
+# python -m pytest -q tests
+# قاعدة SQLite مؤقتة؛ لازم DATABASE_URL يتضبط قبل import db لأن الـ engine يتبنى وقت الاستيراد
+
+import asyncio
+import os
+import sys
+import tempfile
+from datetime import datetime
+
+_tmp = tempfile.mkdtemp(prefix="bodytalk-tests-")
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.join(_tmp, 'test.db')}"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import func, select  # noqa: E402
+
+from db import AsyncSessionLocal, Base, engine  # noqa: E402
+from models import BodyAnalysis  # noqa: E402
+from write_behind import WriteBehindBuffer  # noqa: E402
+
+
+async def _count_rows() -> int:
+    async with AsyncSessionLocal() as session:
+        return await session.scalar(select(func.count()).select_from(BodyAnalysis))
+
+
+async def _wait_for(condition, timeout: float = 5.0) -> None:
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not await condition():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.02)
+
+
+def test_overflow_is_spilled_and_replayed_while_running(tmp_path):
+    spill_path = str(tmp_path / "spill.jsonl")
+
+    async def scenario():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        before = await _count_rows()
+
+        writer = WriteBehindBuffer(batch_rows=100, flush_seconds=0.05, max_buffer=2, spill_path=spill_path)
+        await writer.start()
+        try:
+            enqueue_start = datetime.utcnow()
+            writer.add(*(BodyAnalysis(shape=f"s{i}", bmi=float(i)) for i in range(5)))
+            enqueue_end = datetime.utcnow()
+            assert writer.stats()["spilled"] == 3
+            assert os.path.exists(spill_path)
+
+            async def all_written():
+                return await _count_rows() - before == 5
+
+            # بدون إعادة تشغيل: الـ flush loop نفسه يكتب صفوف الملف
+            await _wait_for(all_written)
+        finally:
+            await writer.stop()
+
+        stats = writer.stats()
+        assert stats["replayed"] == 3
+        assert stats["flushed_rows"] == 2
+        assert not os.path.exists(spill_path)
+        assert not os.path.exists(spill_path + ".replay")
+
+        # created_at وقت الطلب، حتى للصفوف اللي مرت على ملف الـ spill
+        async with AsyncSessionLocal() as session:
+            created = (
+                await session.scalars(
+                    select(BodyAnalysis.created_at).order_by(BodyAnalysis.id.desc()).limit(5)
+                )
+            ).all()
+        assert all(enqueue_start <= value <= enqueue_end for value in created)
+
+    asyncio.run(scenario())
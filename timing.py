@@ -0,0 +1,58 @@
+# timing.py
+#
+# قياس زمن مراحل الطلب (فك الترميز، الدمج، الكتابة في قاعدة البيانات...)
+# وطباعتها في الـ log وتسجيلها في bodytalk_analysis_stage_seconds.
+
+import logging
+import time
+from contextlib import contextmanager
+from typing import Awaitable, Dict, Iterator, Mapping, TypeVar
+
+from metrics import analysis_stage_seconds
+
+logger = logging.getLogger("bodytalk.timing")
+
+T = TypeVar("T")
+
+
+class StageTimer:
+    """Collects wall-clock durations of the named stages of one request.
+
+    Stages may overlap (e.g. two decodes awaited with asyncio.gather), so the
+    stage durations can add up to more than the total.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.stages: Dict[str, float] = {}
+        self._started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[stage] = time.perf_counter() - start
+
+    async def timed(self, stage: str, awaitable: Awaitable[T]) -> T:
+        with self.stage(stage):
+            return await awaitable
+
+    def record(self, timings: Mapping[str, float], prefix: str = "") -> None:
+        """Add durations measured elsewhere (e.g. inside a pool worker)."""
+        for stage, seconds in timings.items():
+            self.stages[prefix + stage] = seconds
+
+    @property
+    def total(self) -> float:
+        return time.perf_counter() - self._started
+
+    def finish(self) -> None:
+        total = self.total
+        for stage, seconds in self.stages.items():
+            analysis_stage_seconds.observe(seconds, pipeline=self.name, stage=stage)
+        analysis_stage_seconds.observe(total, pipeline=self.name, stage="total")
+
+        parts = " ".join(f"{stage}={seconds * 1000:.1f}ms" for stage, seconds in self.stages.items())
+        logger.info("%s %s total=%.1fms", self.name, parts, total * 1000)
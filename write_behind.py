@@ -0,0 +1,268 @@
+# write_behind.py
+#
+# وضع write-behind لحفظ نتائج التحليل: بدل commit لكل طلب (fsync لكل صف)،
+# الصفوف تنضاف لـ buffer داخل العملية وتنكتب دفعة وحدة (INSERT واحد بعدة صفوف
+# + commit واحد) كل WRITE_BEHIND_BATCH_ROWS صف أو كل WRITE_BEHIND_FLUSH_MS.
+# الرد يرجع بدون ما ينتظر الكتابة، فالصف ممكن يتأخر لحد FLUSH_MS قبل ما يظهر في السجل.
+#
+# created_at هو وقت الطلب (ينحفظ مع الصف حتى في ملف الـ spill)، فممكن يكون أقدم
+# من صفوف انكتبت قبله؛ لهذا السجل وcursor الـ since مرتبين بالـ id (pagination.py).
+#
+# لو قاعدة البيانات فشلت نعيد المحاولة؛ وعند الإيقاف (أو لو الـ buffer امتلأ)
+# الصفوف اللي ما انكتبت تنحفظ في ملف JSONL، وتنكتب في القاعدة بعد أول دفعة
+# ناجحة (أو عند التشغيل التالي). worker واحد بس يعيد الملف (flock، وعلى Windows
+# بدون قفل لأنه تشغيل محلي بـ worker واحد)، والملف ما ينحذف إلا بعد commit ناجح.
+#
+# ANALYSIS_WRITE_MODE=sync (الافتراضي) يخلي الكتابة المتزامنة القديمة كما هي.
+
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import DateTime, insert
+
+from db import AsyncSessionLocal, Base
+
+logger = logging.getLogger("bodytalk.write_behind")
+
+# "sync" = commit داخل الطلب، "write_behind" = buffer + كتابة دفعات
+ANALYSIS_WRITE_MODE = os.getenv("ANALYSIS_WRITE_MODE", "sync").lower()
+# نكتب الدفعة لما يوصل الـ buffer لهالعدد...
+WRITE_BEHIND_BATCH_ROWS = int(os.getenv("WRITE_BEHIND_BATCH_ROWS", "200"))
+# ...أو بعد هالمدة من أول صف ينتظر (ميلي ثانية)
+WRITE_BEHIND_FLUSH_MS = float(os.getenv("WRITE_BEHIND_FLUSH_MS", "250"))
+# أقصى عدد صفوف في الذاكرة؛ الزيادة تروح لملف الـ spill
+WRITE_BEHIND_MAX_BUFFER = int(os.getenv("WRITE_BEHIND_MAX_BUFFER", "10000"))
+# ملف الصفوف اللي ما انكتبت (عند الإيقاف أو لما القاعدة واقفة)
+WRITE_BEHIND_SPILL_PATH = os.getenv("WRITE_BEHIND_SPILL_PATH", "write_behind_spill.jsonl")
+
+Row = Tuple[str, dict]  # (اسم الجدول, قيم الأعمدة)
+
+
+def _model_for(table: str):
+    for mapper in Base.registry.mappers:
+        if mapper.local_table.name == table:
+            return mapper.class_
+    raise KeyError(table)
+
+
+def _row_values(obj) -> dict:
+    values = {
+        column.key: getattr(obj, column.key)
+        for column in obj.__table__.columns
+        if not column.primary_key
+    }
+    # الـ default حق العمود ينحسب وقت الـ INSERT؛ نثبته وقت الطلب
+    if "created_at" in values and values["created_at"] is None:
+        values["created_at"] = datetime.utcnow()
+    return values
+
+
+class WriteBehindBuffer:
+    def __init__(
+        self,
+        batch_rows: int,
+        flush_seconds: float,
+        max_buffer: int,
+        spill_path: str,
+    ) -> None:
+        self.batch_rows = batch_rows
+        self.flush_seconds = flush_seconds
+        self.max_buffer = max_buffer
+        self.spill_path = spill_path
+        self._rows: List[Row] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.enqueued = 0
+        self.flushed_rows = 0
+        self.flushes = 0
+        self.failures = 0
+        self.spilled = 0
+        self.replayed = 0
+        self._replay_pending = False
+
+    # ---------- public ----------
+
+    async def start(self) -> None:
+        self._wakeup = asyncio.Event()
+        await self._try_replay()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._rows:
+            try:
+                await self._flush()
+            except Exception:
+                logger.exception("final write-behind flush failed, spilling %d rows", len(self._rows))
+                self._spill(self._rows)
+                self._rows = []
+
+    def add(self, *objects) -> None:
+        """Queue ORM instances for insertion; returns immediately."""
+        for obj in objects:
+            self._rows.append((obj.__tablename__, _row_values(obj)))
+        self.enqueued += len(objects)
+
+        if len(self._rows) > self.max_buffer:
+            # القاعدة ما تلحق (أو واقفة): الزيادة للقرص بدل ما تكبر الذاكرة بلا حد
+            overflow = self._rows[: len(self._rows) - self.max_buffer]
+            self._rows = self._rows[len(overflow):]
+            self._spill(overflow)
+
+        if self._wakeup is not None and len(self._rows) >= self.batch_rows:
+            self._wakeup.set()
+
+    def stats(self) -> dict:
+        return {
+            "mode": ANALYSIS_WRITE_MODE,
+            "pending": len(self._rows),
+            "enqueued": self.enqueued,
+            "flushed_rows": self.flushed_rows,
+            "flushes": self.flushes,
+            "failures": self.failures,
+            "spilled": self.spilled,
+            "replayed": self.replayed,
+        }
+
+    # ---------- internals ----------
+
+    async def _run(self) -> None:
+        backoff = self.flush_seconds
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if not self._rows and not self._replay_pending:
+                continue
+            try:
+                if self._rows:
+                    await self._flush()
+                if self._replay_pending:
+                    # صفوف انكتبت في ملف الـ spill (buffer امتلأ، أو فشل عند التشغيل)
+                    await self._replay_spill()
+                    self._replay_pending = False
+                backoff = self.flush_seconds
+            except Exception:
+                self.failures += 1
+                logger.exception("write-behind flush failed; %d rows pending", len(self._rows))
+                # الصفوف باقية في الـ buffer أو الملف؛ نستنى أكثر قبل المحاولة التالية
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+
+    async def _flush(self) -> None:
+        rows, self._rows = self._rows, []
+        try:
+            await self._insert(rows)
+        except BaseException:
+            # نرجعها لأول الـ buffer بنفس الترتيب
+            self._rows = rows + self._rows
+            raise
+        self.flushed_rows += len(rows)
+        self.flushes += 1
+
+    async def _insert(self, rows: List[Row]) -> None:
+        by_table: Dict[str, List[dict]] = {}
+        for table, values in rows:
+            by_table.setdefault(table, []).append(values)
+
+        async with AsyncSessionLocal() as session:
+            for table, values in by_table.items():
+                # executemany لـ INSERT واحد؛ كل الدفعة في transaction وحدة
+                await session.execute(insert(_model_for(table)), values)
+            await session.commit()
+
+    def _spill(self, rows: List[Row]) -> None:
+        with open(self.spill_path, "a", encoding="utf-8") as f:
+            for table, values in rows:
+                f.write(json.dumps({"table": table, "values": values}, default=_json_default))
+                f.write("\n")
+        self.spilled += len(rows)
+        self._replay_pending = True
+
+    async def _try_replay(self) -> None:
+        try:
+            await self._replay_spill()
+            self._replay_pending = False
+        except Exception:
+            # الملف باقي على القرص؛ الـ flush loop يعيد المحاولة
+            self._replay_pending = True
+            logger.exception("could not replay write-behind spill file")
+
+    async def _replay_spill(self) -> None:
+        with open(f"{self.spill_path}.lock", "a") as lock:
+            if not _try_lock(lock):
+                # worker ثاني يعيد الملف الآن
+                return
+            # نعيد تسمية الملف أول حتى صفوف spill جديدة ما تختلط مع اللي نكتبها الآن؛
+            # .replay موجود = محاولة سابقة فشلت، فيتكتب قبل الملف الجديد
+            replaying = f"{self.spill_path}.replay"
+            while True:
+                if not os.path.exists(replaying):
+                    try:
+                        os.replace(self.spill_path, replaying)
+                    except FileNotFoundError:
+                        return
+                rows = _read_spill(replaying)
+                if rows:
+                    await self._insert(rows)
+                # بعد الـ commit بس؛ لو الـ insert فشل الملف يبقى للمحاولة التالية
+                os.remove(replaying)
+                self.replayed += len(rows)
+
+
+def _try_lock(f) -> bool:
+    """Non-blocking exclusive flock; always succeeds where fcntl is missing (Windows)."""
+    try:
+        import fcntl
+    except ImportError:
+        return True
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+
+def _read_spill(path: str) -> List[Row]:
+    rows: List[Row] = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                rows.append((entry["table"], _parse_values(entry["table"], entry["values"])))
+    return rows
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"not JSON serializable: {type(value).__name__}")
+
+
+def _parse_values(table: str, values: dict) -> dict:
+    columns = _model_for(table).__table__.columns
+    for key, value in values.items():
+        if isinstance(value, str) and isinstance(columns[key].type, DateTime):
+            values[key] = datetime.fromisoformat(value)
+    return values
+
+
+def write_behind_enabled() -> bool:
+    return ANALYSIS_WRITE_MODE == "write_behind"
+
+
+analysis_writer = WriteBehindBuffer(
+    WRITE_BEHIND_BATCH_ROWS,
+    WRITE_BEHIND_FLUSH_MS / 1000,
+    WRITE_BEHIND_MAX_BUFFER,
+    WRITE_BEHIND_SPILL_PATH,
+)